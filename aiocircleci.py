@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+# asyncio counterparts of the endpoint functions in circleci.py, sharing its cache and settings.
+# Calls must happen inside `async with client():`, which owns the aiohttp session they use.
+
+import asyncio
+import contextlib
+import contextvars
+import json
+import time
+
+import aiohttp
+
+import circleci
+
+_session = contextvars.ContextVar("session")
+
+
+@contextlib.asynccontextmanager
+async def client(limit=256):
+    connect, read = circleci.transport.timeout
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=limit),
+        timeout=aiohttp.ClientTimeout(connect=connect, sock_read=read),
+        raise_for_status=False,
+    ) as session:
+        reset = _session.set(session)
+        try:
+            yield session
+        finally:
+            _session.reset(reset)
+
+
+async def acquire(limiter):
+    t0 = time.monotonic()
+    delay = limiter.try_acquire()
+    if delay:
+        limiter.begin_wait()
+        try:
+            while delay:
+                await asyncio.sleep(delay)
+                delay = limiter.try_acquire()
+        finally:
+            limiter.end_wait()
+    return t0
+
+
+async def api_get(
+    url,
+    _version="2",
+    _cache_key=None,
+    _cache_filter=None,
+    _cache_max_age=None,
+    headers=None,
+    params=None,
+    **kwargs,
+):
+    mkey = circleci.memory_key(_version, url, params)
+    while True:
+        j = circleci.cache_load(mkey, _cache_key, _cache_max_age)
+        if j is not None:
+            circleci.API_CALLS.inc(circleci.endpoint(url), j[circleci.CACHE_KEY])
+            return j
+        future, leader = circleci.inflight.join(mkey)
+        if leader:
+            break
+        try:
+            # Shielded so that cancelling this waiter doesn't cancel the shared future.
+            j = await asyncio.shield(asyncio.wrap_future(future))
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+        else:
+            circleci.API_CALLS.inc(circleci.endpoint(url), "coalesced")
+            return {circleci.CACHE_KEY: "coalesced", **j}
+
+    try:
+        j, size = await fetch(url, _version, headers, params, kwargs)
+        circleci.cache_store(mkey, _cache_key, j, size, _cache_filter)
+    except BaseException as e:
+        circleci.inflight.abandon(mkey, future, e)
+        raise
+    circleci.inflight.finish(mkey, future, j)
+    circleci.API_CALLS.inc(circleci.endpoint(url), "api")
+    return j
+
+
+async def fetch(url, version, headers, params, kwargs):
+    headers = circleci.auth_headers(headers)
+    # requests drops None-valued params; aiohttp rejects them.
+    if params is not None:
+        params = {k: v for k, v in params.items() if v is not None}
+
+    session = _session.get()
+    limiter = circleci.limiter
+    attempt = 0
+    while True:
+        started = await acquire(limiter)
+        status = delay = None
+        full_url = f"{circleci.API_URL}/v{version}/{url}"
+        t0 = time.monotonic()
+        try:
+            async with session.get(full_url, headers=headers, params=params, **kwargs) as r:
+                status = r.status
+                delay = circleci.retry_after(r.headers)
+                if r.status < 400:
+                    body = await r.read()
+                    return json.loads(body), len(body)
+
+                wait = limiter.retry_delay(attempt, r.status, delay)
+                if wait is None:
+                    r.raise_for_status()
+        finally:
+            limiter.release(started, status, delay)
+            if status is not None:
+                elapsed = time.monotonic() - t0
+                circleci.observe_request({"url": full_url, "status": status, "elapsed": elapsed})
+        print(f"retrying {url} ({status}) after {wait:.1f}s")
+        await asyncio.sleep(wait)
+        attempt += 1
+
+
+async def pipelines(org_slug, page_token=None):
+    return await api_get(
+        "pipeline", params={"org-slug": org_slug, "page-token": page_token, "mine": "false"}
+    )
+
+
+async def project_pipelines(slug, branch, page_token=None):
+    return await api_get(
+        f"project/{slug}/pipeline",
+        params={"page-token": page_token, "branch": branch},
+    )
+
+
+async def pipeline(slug, num):
+    return await api_get(
+        f"project/{slug}/pipeline/{num}",
+        _cache_key=circleci.pipeline_key(slug, num),
+        _cache_filter=circleci.pipeline_settled,
+    )
+
+
+async def pipeline_workflows(uuid, page_token=None, slug=None, pipeline_number=None):
+    return await api_get(
+        f"pipeline/{uuid}/workflow",
+        params={"page-token": page_token},
+        _cache_key=circleci.CacheKey("pipeline_workflows", uuid, slug, pipeline_number)
+        if page_token is None
+        else None,
+        _cache_filter=circleci.workflows_settled,
+        _cache_max_age=circleci.settled_max_age,
+    )
+
+
+async def workflow_jobs(uuid, page_token=None, slug=None, pipeline_number=None):
+    return await api_get(
+        f"workflow/{uuid}/job",
+        params={"page-token": page_token},
+        # The disk cache holds first pages only; it's keyed by workflow, not by page.
+        _cache_key=circleci.CacheKey("workflow_jobs", uuid, slug, pipeline_number)
+        if page_token is None
+        else None,
+        _cache_filter=circleci.jobs_finished,
+    )
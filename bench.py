@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+# Offline benchmarks against fakeapi.py: no token or network needed. Scenarios print as they go,
+# and --json writes all their results, with the commit they were measured at, for comparing later.
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import circleci
+import cisummary
+import fakeapi
+
+SLUG = "github/example-org/example-repo"
+
+
+@contextlib.contextmanager
+def scratch_dir():
+    # get_data reads and writes cache/ and snapshots/ relative to the working directory.
+    old = os.getcwd()
+    d = tempfile.mkdtemp()
+    os.mkdir(os.path.join(d, "cache"))
+    os.chdir(d)
+    try:
+        yield d
+    finally:
+        cisummary.snapshots.flush()
+        os.chdir(old)
+        shutil.rmtree(d)
+
+
+def reset_caches():
+    # Everything a cold start wouldn't have. The disk cache is left to scratch_dir.
+    circleci.memory_cache.clear()
+    circleci.parse_time.cache_clear()
+    cisummary.sync_states.clear()
+
+
+def timed(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    ret = func(*args, **kwargs)
+    return time.perf_counter() - t0, ret
+
+
+def bench_engines(args):
+    results = {}
+    for engine in args.engines:
+        times = []
+        for _ in range(args.repeat):
+            with scratch_dir():
+                reset_caches()
+                dt, (_, meta) = timed(
+                    cisummary.get_data, SLUG, None, pages=args.pages, jobs=args.jobs, engine=engine
+                )
+            times.append(dt)
+        results[engine] = {"min": min(times), "max": max(times), "requests": meta["total_requests"]}
+        print(
+            f"{engine:8} {meta['total_requests']} requests: "
+            f"min {min(times):.3f}s, max {max(times):.3f}s"
+        )
+        if args.rate_limit:
+            print(f"{'':8} {meta['rate_limiter']}")
+    return results
+
+
+def bench_get_data(args):
+    # A cold load, then the same view again once what may still change has dropped out of the
+    # memory cache (as the next page view after the live TTL would), with a full crawl and with an
+    # incremental one. Within the TTL both would be answered from memory without a request.
+    results = {}
+    live_ttl = circleci.memory_cache.live_ttl
+    circleci.memory_cache.live_ttl = 0
+    try:
+        for incremental in (False, True):
+            cold, warm = [], []
+            for _ in range(args.repeat):
+                with scratch_dir():
+                    reset_caches()
+                    kwargs = dict(pages=args.pages, jobs=args.jobs, incremental=incremental)
+                    dt, (_, cold_meta) = timed(cisummary.get_data, SLUG, None, **kwargs)
+                    cold.append(dt)
+                    dt, (_, warm_meta) = timed(cisummary.get_data, SLUG, None, **kwargs)
+                    warm.append(dt)
+            name = "incremental" if incremental else "full"
+            results[name] = {
+                "cold": min(cold),
+                "warm": min(warm),
+                "cold_requests": cold_meta["uncached_requests"],
+                "warm_requests": warm_meta["uncached_requests"],
+                "cold_hit_rates": cold_meta["hit_rates"],
+            }
+            print(
+                f"{name:12} cold {min(cold):.3f}s ({cold_meta['uncached_requests']} requests), "
+                f"warm {min(warm):.3f}s ({warm_meta['uncached_requests']} requests)"
+            )
+    finally:
+        circleci.memory_cache.live_ttl = live_ttl
+    return results
+
+
+def bench_timeline(args, org):
+    import timeline
+
+    workflow = org.workflows[org.pipelines[SLUG][-1]["id"]][0]["id"]
+    formats = ["svg"]
+    try:
+        import matplotlib  # noqa: F401
+
+        formats += ["pdf", "png"]
+    except ImportError:
+        print("matplotlib isn't installed; only timing SVG timelines")
+
+    results = {}
+    for fmt in formats:
+        cold, warm = [], []
+        for _ in range(args.repeat):
+            with scratch_dir():
+                reset_caches()
+                cold.append(timed(timeline.make, workflow, f"timeline.{fmt}")[0])
+                warm.append(timed(timeline.make, workflow, f"timeline.{fmt}")[0])
+        results[fmt] = {"cold": min(cold), "warm": min(warm)}
+        print(f"{fmt:4} cold {min(cold):.4f}s, warm {min(warm):.4f}s")
+    return results
+
+
+def bench_serve(args, org, slugs):
+    # Whole requests through the Flask app, from routing to the last byte of the gzipped body.
+    import serv
+
+    serv.allowed_slugs = set(slugs)
+    # Whatever config files the working directory has aren't this fake org's.
+    serv.config_check_interval = float("inf")
+    client = serv.app.test_client()
+    workflow = org.workflows[org.pipelines[SLUG][-1]["id"]][0]["id"]
+    routes = {
+        "main": f"/{SLUG}/main",
+        "pulls": f"/{SLUG}/pulls",
+        "tags": f"/{SLUG}/tags",
+        "overview": "/" + SLUG.rsplit("/", 1)[0],
+        "timeline": f"/{SLUG}/workflow_timeline/{workflow}",
+        "metrics": "/metrics",
+    }
+
+    def get(url):
+        r = client.get(url)
+        r.get_data()
+        assert r.status_code == 200, (url, r.status_code)
+
+    results = {}
+    for name, url in routes.items():
+        cold, warm = [], []
+        for _ in range(args.repeat):
+            with scratch_dir():
+                reset_caches()
+                serv.page_cache.invalidate()
+                serv.timeline_cache = serv.TimelineCache()
+                cold.append(timed(get, url)[0])
+                warm.append(timed(get, url)[0])
+        results[name] = {"cold": min(cold), "warm": min(warm)}
+        print(f"{name:9} cold {min(cold):.4f}s, warm {min(warm):.4f}s")
+    return results
+
+
+def synthetic_crawl(pipelines, workflows, jobs):
+    # A finished crawl filled directly from a FakeOrg, skipping HTTP entirely.
+    org = fakeapi.FakeOrg([SLUG], pipelines=pipelines, workflows=workflows, jobs=jobs)
+    crawl = cisummary.Crawl(SLUG, None, 0, lambda p: True)
+    for p in org.pipelines[SLUG]:
+        crawl.pipelines_map[p["number"]] = p
+        crawl.workflows_map[p["id"]] = org.workflows[p["id"]]
+        for w in org.workflows[p["id"]]:
+            crawl.jobs_map[w["id"]] = org.jobs[w["id"]]
+    return crawl
+
+
+def synthetic_data(pipelines, workflows, jobs):
+    return synthetic_crawl(pipelines, workflows, jobs).result()
+
+
+def bench_render(args):
+    # Ingest (Crawl.result, where timestamps are parsed) plus the page render with each renderer.
+    results = {}
+    for size in args.sizes:
+        pipelines, workflows, jobs = map(int, size.split("x"))
+        crawl = synthetic_crawl(pipelines, workflows, jobs)
+        times = []
+        for _ in range(args.repeat):
+            circleci.parse_time.cache_clear()
+            dt, (data, meta) = timed(crawl.result)
+            times.append(dt)
+        result = results[size] = {"ingest": min(times)}
+        line = f"{size:12} ingest {min(times):.3f}s"
+
+        # What a served snapshot keeps alive, beyond the raw responses the caches hold anyway.
+        circleci.parse_time.cache_clear()
+        tracemalloc.start()
+        data, meta = crawl.result()
+        result["memory"] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        line += f" {result['memory'] / 2**20:.1f}MiB"
+        for renderer in cisummary.RENDERERS:
+            stream = lambda: "".join(  # noqa: E731
+                cisummary.proc_stream(SLUG, data, meta, renderer=renderer)
+            )
+            times = [timed(stream)[0] for _ in range(args.repeat)]
+            result[renderer] = min(times)
+            line += f" {renderer} {min(times):.3f}s"
+        # The whole document at once, as proc builds it.
+        proc = lambda: str(cisummary.proc(SLUG, data, meta))  # noqa: E731
+        times = [timed(proc)[0] for _ in range(args.repeat)]
+        result["proc"] = min(times)
+        line += f" proc {min(times):.3f}s"
+        print(line)
+    return results
+
+
+def git_commit():
+    try:
+        r = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return None
+    return r.stdout.strip() or None
+
+
+SCENARIOS = ["crawl", "get_data", "render", "timeline", "serve"]
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenarios", nargs="*", choices=SCENARIOS + ["all"], default=["crawl"])
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    parser.add_argument(
+        "--engines", nargs="+", choices=cisummary.ENGINES, default=cisummary.ENGINES
+    )
+    parser.add_argument("--pages", type=int, default=5)
+    parser.add_argument("-J", "--jobs", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--repos", type=int, default=1, help="repos in the fake org")
+    parser.add_argument("--pipelines", type=int, default=200)
+    parser.add_argument("--workflows", type=int, default=3)
+    parser.add_argument("--workflow-jobs", type=int, default=20)
+    parser.add_argument("--rerun-ratio", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--rate-limit", type=float, default=None, help="fake API requests/s")
+    parser.add_argument("--burst", type=int, default=None)
+    parser.add_argument("--throttle-ratio", type=float, default=0.0, help="fake API random 429s")
+    # PIPELINESxWORKFLOWSxJOBS, with JOBS per workflow.
+    parser.add_argument("--sizes", nargs="+", default=["50x2x10", "200x4x20", "500x4x40"])
+
+    args = parser.parse_args(args)
+    scenarios = SCENARIOS if "all" in args.scenarios else args.scenarios
+
+    # Every request goes to the fake API, so any token will do.
+    circleci.token = "fake"
+    slugs = [SLUG] + [f"github/example-org/repo{i}" for i in range(1, args.repos)]
+    server, org = fakeapi.serve(
+        slugs,
+        pipelines=args.pipelines,
+        workflows=args.workflows,
+        jobs=args.workflow_jobs,
+        rerun_ratio=args.rerun_ratio,
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        burst=args.burst,
+        throttle_ratio=args.throttle_ratio,
+    )
+    circleci.API_URL = f"http://127.0.0.1:{server.server_port}/api"
+
+    results = {}
+    for scenario in scenarios:
+        print(f"== {scenario}")
+        if scenario == "crawl":
+            results[scenario] = bench_engines(args)
+        elif scenario == "get_data":
+            results[scenario] = bench_get_data(args)
+        elif scenario == "render":
+            results[scenario] = bench_render(args)
+        elif scenario == "timeline":
+            results[scenario] = bench_timeline(args, org)
+        elif scenario == "serve":
+            results[scenario] = bench_serve(args, org, slugs)
+    server.shutdown()
+
+    if args.json:
+        report = {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "time": time.time(),
+            "args": vars(args),
+            "results": results,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    exit(main(sys.argv[1:]))
@@ -1,70 +1,946 @@
 #!/usr/bin/env python3
 
+import argparse
+import contextlib
+import datetime
+import functools
+import itertools
 import json
 import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
 import time
+from collections import OrderedDict, deque
+from concurrent.futures import CancelledError, Future
+from typing import NamedTuple, Optional
 
 import requests
 
-token = os.environ["CIRCLECI_TOKEN"]
+import metrics
 
+# Only needed once a request is made, so importing this (e.g. to run bench.py) doesn't need one.
+token = os.environ.get("CIRCLECI_TOKEN")
+
+# Set on responses served from a cache, to the name of the tier ("memory" or "disk"), or to
+# "coalesced" on ones shared with a concurrent identical request.
 CACHE_KEY = "__cached"
 
+FINISHED_WORKFLOW_STATUSES = {"success", "failed", "error", "canceled", "unauthorized", "not_run"}
+
+API_URL = os.environ.get("CIRCLECI_API_URL", "https://circleci.com/api")
+
+
+class SessionPool:
+    # Sessions are handed out to one thread at a time, so each keeps its own keep-alive connection
+    # to the API warm across requests without having to share a session between threads.
+    def __init__(self, size=32, connect_timeout=5.0, read_timeout=60.0):
+        self.size = size
+        self.timeout = (connect_timeout, read_timeout)
+        self.stats_hooks = []
+        self._idle = []
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._created = 0
+        self._checked_out = 0
+        self._requests = 0
+        self._connections = 0
+        self._waits = 0
+
+    def _new_session(self):
+        s = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        s.mount("https://", adapter)
+        s.mount("http://", adapter)
+        return s
+
+    def resize(self, size):
+        with self._cond:
+            if size > self.size:
+                self.size = size
+                self._cond.notify_all()
+
+    def configure(self, size=None, connect_timeout=None, read_timeout=None):
+        if size is not None:
+            self.resize(size)
+        connect, read = self.timeout
+        self.timeout = (
+            connect if connect_timeout is None else connect_timeout,
+            read if read_timeout is None else read_timeout,
+        )
+
+    @contextlib.contextmanager
+    def session(self):
+        with self._cond:
+            while not self._idle and self._created >= self.size:
+                self._waits += 1
+                self._cond.wait()
+            if self._idle:
+                s = self._idle.pop()
+            else:
+                self._created += 1
+                s = None
+            self._checked_out += 1
+        if s is None:
+            s = self._new_session()
+        try:
+            yield s
+        finally:
+            with self._cond:
+                self._checked_out -= 1
+                self._idle.append(s)
+                self._cond.notify()
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        with self.session() as s:
+            conns_before = _open_connections(s)
+            t0 = time.monotonic()
+            r = s.request(method, url, *args, **kwargs)
+            elapsed = time.monotonic() - t0
+            new_connection = _open_connections(s) > conns_before
+        with self._lock:
+            self._requests += 1
+            self._connections += new_connection
+        for hook in self.stats_hooks:
+            hook(
+                {
+                    "method": method,
+                    "url": url,
+                    "status": r.status_code,
+                    "elapsed": elapsed,
+                    "new_connection": new_connection,
+                }
+            )
+        return r
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "sessions": self._created,
+                "checked_out": self._checked_out,
+                "requests": self._requests,
+                "connections": self._connections,
+                "waits": self._waits,
+            }
+
+
+def _open_connections(session):
+    n = 0
+    for adapter in session.adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            n += pools[key].num_connections
+    return n
+
+
+transport = SessionPool(
+    connect_timeout=float(os.environ.get("CIRCLECI_CONNECT_TIMEOUT", 5)),
+    read_timeout=float(os.environ.get("CIRCLECI_READ_TIMEOUT", 60)),
+)
+
+API_SECONDS = metrics.Histogram(
+    "circleci_api_request_seconds",
+    "API requests by endpoint and response status, each retry counted separately.",
+    ["endpoint", "status"],
+)
+
+ID_RE = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|\d+")
+
+
+@functools.lru_cache(maxsize=1 << 12)
+def endpoint(url):
+    # The API path with the version, ids, numbers and project slug taken out, to label metrics with.
+    parts = re.sub(r"^.*?/v\d+/", "", url).split("/")
+    if parts[0] == "project":
+        parts[1:4] = [":slug"]
+    return "/".join(":id" if ID_RE.fullmatch(part) else part for part in parts)
+
+
+def observe_request(stats):
+    API_SECONDS.observe(stats["elapsed"], endpoint(stats["url"]), stats["status"])
+
 
+transport.stats_hooks.append(observe_request)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    # Shared by every API request in the process, threaded or async. Requests start only while
+    # there are tokens in a bucket refilled at `rate` per second, and only while fewer than a window
+    # of them are in flight. Both adapt AIMD-style: they halve when the API rate-limits us and grow
+    # back gradually as requests succeed. A Retry-After pauses every client, not just the one that
+    # got it.
+    #
+    # Without a configured `rate` the bucket is off until the first 429, and then starts from half
+    # the rate requests were being sent at. `try_acquire` never blocks, so the async client can wait
+    # with asyncio.sleep instead.
+    POLL = 0.01
+    # Seconds of successes that win back as much rate again as there is, so a halving is undone in
+    # about the same time whatever the rate.
+    RECOVERY = 2.0
+
+    def __init__(
+        self,
+        rate=None,
+        burst=None,
+        max_concurrency=256,
+        min_concurrency=1,
+        retries=5,
+        retry_budget=20,
+        backoff=0.5,
+        max_backoff=30.0,
+    ):
+        self.max_rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.retries = retries
+        self.max_budget = retry_budget
+        self.backoff_base = backoff
+        self.max_backoff = max_backoff
+        self._cond = threading.Condition()
+        self._rate = rate
+        self._tokens = self._burst()
+        self._updated = time.monotonic()
+        self._sent = deque()
+        self._limit = float(max_concurrency)
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._decreased_at = 0.0
+        self._increased_at = 0.0
+        self._budget = float(retry_budget)
+        self._throttled = 0
+        self._retries = 0
+        self._exhausted = 0
+        self._waits = 0
+        self._waiting = 0
+        self._waiting_since = 0.0
+        self._throttled_seconds = 0.0
+
+    def _burst(self):
+        if self._rate is None:
+            return 0
+        return self.burst or max(1.0, self._rate / 10)
+
+    def _try_acquire(self, now):
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._in_flight >= int(self._limit):
+            return self.POLL
+        if self._rate:
+            self._tokens = min(self._burst(), self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens < 1:
+                return (1 - self._tokens) / self._rate
+            self._tokens -= 1
+        self._in_flight += 1
+        # Sends in the last second, for picking a rate at the first 429.
+        self._sent.append(now)
+        while self._sent[0] < now - 1:
+            self._sent.popleft()
+        return 0
+
+    def try_acquire(self):
+        # 0 if a request may start now (it must then be released), else how long to wait.
+        with self._cond:
+            return self._try_acquire(time.monotonic())
+
+    def acquire(self):
+        t0 = time.monotonic()
+        with self._cond:
+            delay = self._try_acquire(t0)
+            if delay:
+                self._wait(t0, 1)
+                while delay:
+                    self._cond.wait(delay)
+                    delay = self._try_acquire(time.monotonic())
+                self._wait(time.monotonic(), -1)
+        return t0
+
+    def _wait(self, now, change):
+        # throttled_seconds is the wall-clock time during which any request was kept waiting,
+        # however many were.
+        if self._waiting:
+            self._throttled_seconds += now - self._waiting_since
+        self._waiting_since = now
+        self._waiting += change
+        if change > 0:
+            self._waits += 1
+
+    def begin_wait(self):
+        # For clients that wait on try_acquire themselves: call once a request has to wait, and
+        # end_wait once it may start (or gives up).
+        with self._cond:
+            self._wait(time.monotonic(), 1)
+
+    def end_wait(self):
+        with self._cond:
+            self._wait(time.monotonic(), -1)
+
+    def release(self, started, status=None, retry_after=None):
+        # `started` is when the request was acquired; only requests sent since the last decrease
+        # shrink the window, so one burst of 429s halves it once rather than once per response.
+        with self._cond:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if status == 429:
+                self._throttled += 1
+                if started >= self._decreased_at:
+                    self._limit = max(self.min_concurrency, self._limit / 2)
+                    if self._rate is None:
+                        span = max(0.1, now - self._sent[0]) if self._sent else 1.0
+                        self._rate = len(self._sent) / span
+                    self._rate = max(1.0, self._rate / 2)
+                    self._tokens = min(self._tokens, self._burst())
+                    self._decreased_at = now
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+            elif status is not None and status < 400:
+                self._limit = min(self.max_concurrency, self._limit + 1 / self._limit)
+                elapsed = min(self.RECOVERY, now - self._increased_at)
+                self._increased_at = now
+                # Only grown while requests are actually being sent at close to the rate, or it
+                # would run away while the crawl is the bottleneck.
+                if self._rate is not None and len(self._sent) >= self._rate / 2:
+                    self._rate += self._rate * elapsed / self.RECOVERY
+                    if self.max_rate is not None:
+                        self._rate = min(self.max_rate, self._rate)
+                self._budget = min(self.max_budget, self._budget + 0.1)
+            self._cond.notify_all()
+
+    def retry_delay(self, attempt, status, retry_after):
+        # Seconds to wait before retrying, or None if the request should fail.
+        if status not in RETRY_STATUSES:
+            return None
+        # A 429 with a Retry-After has already paused everyone and shrunk the window, so it's
+        # retried without waiting further or drawing on the budget, which is for actual failures.
+        paced = status == 429 and retry_after is not None
+        with self._cond:
+            if attempt >= self.retries or (not paced and self._budget < 1):
+                self._exhausted += 1
+                return None
+            if not paced:
+                self._budget -= 1
+            self._retries += 1
+        if paced:
+            return 0
+        if retry_after is not None:
+            return retry_after
+        # Full jitter, so clients that failed together don't retry together.
+        return random.uniform(0, min(self.max_backoff, self.backoff_base * 2 ** attempt))
+
+    def stats(self):
+        with self._cond:
+            self._wait(time.monotonic(), 0)
+            return {
+                "concurrency_limit": int(self._limit),
+                "rate": round(self._rate, 1) if self._rate is not None else None,
+                "in_flight": self._in_flight,
+                "throttled": self._throttled,
+                "retries": self._retries,
+                "retries_exhausted": self._exhausted,
+                "waits": self._waits,
+                "throttled_seconds": round(self._throttled_seconds, 3),
+            }
+
+
+limiter = RateLimiter(
+    rate=float(os.environ.get("CIRCLECI_RATE_LIMIT", 0)) or None,
+    burst=int(os.environ.get("CIRCLECI_RATE_BURST", 0)) or None,
+    retries=int(os.environ.get("CIRCLECI_MAX_RETRIES", 5)),
+)
+
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+@functools.lru_cache(maxsize=1 << 16)
 def parse_time(s):
-    return time.mktime(time.strptime(s, "%Y-%m-%dT%H:%M:%SZ"))
+    # Whole epoch seconds for the API's "2020-01-02T03:04:05(.678)Z" timestamps; strptime was a
+    # large share of render time. Fractional seconds are dropped.
+    if not s:
+        return None
+    if len(s) < 20 or s[10] != "T" or s[-1] != "Z":
+        raise ValueError(f"unexpected timestamp {s!r}")
+    days = datetime.date(int(s[0:4]), int(s[5:7]), int(s[8:10])).toordinal() - EPOCH_ORDINAL
+    return days * 86400 + int(s[11:13]) * 3600 + int(s[14:16]) * 60 + int(s[17:19])
+
+
+class CacheKey(NamedTuple):
+    kind: str
+    uuid: str
+    slug: Optional[str] = None
+    pipeline_number: Optional[int] = None
+
+    @property
+    def name(self):
+        return f"{self.kind}-{self.uuid}"
+
+    @staticmethod
+    def from_name(name):
+        kind, _, uuid = name.partition("-")
+        return CacheKey(kind, uuid)
+
+    def describe(self, j):
+        # Fill in the index fields the response itself (or, for lists, its first item) carries.
+        item = (j.get("items") or [{}])[0]
+        return self._replace(
+            slug=self.slug or j.get("project_slug") or item.get("project_slug"),
+            pipeline_number=self.pipeline_number or j.get("pipeline_number"),
+        )
+
+
+# Read once, up front: setting it to read it isn't thread-safe.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def atomic_write(path, data):
+    # Write next to the destination and rename over it, so readers, in this process or another, see
+    # either the old file or the whole new one. Concurrent writers of the same file each replace it
+    # whole; the last one wins.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        # mkstemp's files are only readable by their owner; give it what open() would have.
+        os.fchmod(fd, 0o666 & ~UMASK)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class FileCache:
+    # One JSON file per response, named after the key. Safe to share between processes.
+    def __init__(self, root="cache"):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, key.name + ".json")
+
+    def get(self, key, max_age=None):
+        try:
+            with open(self._path(key)) as f:
+                if max_age is not None and time.time() - os.fstat(f.fileno()).st_mtime > max_age:
+                    return None
+                body = f.read()
+        except FileNotFoundError:
+            return None
+        return json.loads(body), len(body)
+
+    def put(self, key, j):
+        atomic_write(self._path(key), json.dumps(j).encode())
+
+    def delete(self, key):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._path(key))
+
+    def keys(self):
+        for fn in os.listdir(self.root):
+            if fn.endswith(".json"):
+                yield CacheKey.from_name(fn[: -len(".json")])
+
+
+class SQLiteCache:
+    # All responses in a single database, indexed by kind, slug, pipeline number and uuid, and
+    # evicted by age and total size. WAL mode lets readers in other threads and processes proceed
+    # while one writer works.
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS responses (
+        name TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        uuid TEXT NOT NULL,
+        slug TEXT,
+        pipeline_number INTEGER,
+        body BLOB NOT NULL,
+        size INTEGER NOT NULL,
+        stored_at REAL NOT NULL,
+        accessed_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS responses_kind_slug_number
+        ON responses (kind, slug, pipeline_number);
+    CREATE INDEX IF NOT EXISTS responses_uuid ON responses (uuid);
+    CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+    """
+
+    # Don't rewrite a row just to bump its access time more often than this.
+    TOUCH_INTERVAL = 600
+    EVICT_EVERY = 256
+
+    def __init__(self, path="cache.db", max_bytes=None, max_age=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._local = threading.local()
+        # next() on a count is atomic, so puts from several threads each get their own number.
+        self._puts = itertools.count(1)
+        self._conn().executescript(self.SCHEMA)
+        # A connection mustn't be used on both sides of a fork (e.g. by serv.py's workers).
+        os.register_at_fork(after_in_child=self._forget_connections)
+
+    def _forget_connections(self):
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, max_age=None):
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT body, stored_at, accessed_at FROM responses WHERE name = ?", (key.name,)
+        ).fetchone()
+        if row is None:
+            return None
+        body, stored_at, accessed_at = row
+        now = time.time()
+        if max_age is not None and now - stored_at > max_age:
+            return None
+        if now - accessed_at > self.TOUCH_INTERVAL:
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE name = ?", (now, key.name))
+        return json.loads(body), len(body)
+
+    def put(self, key, j, stored_at=None):
+        key = key.describe(j)
+        body = json.dumps(j, separators=(",", ":")).encode()
+        now = time.time()
+        self._conn().execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                key.name,
+                key.kind,
+                key.uuid,
+                key.slug,
+                key.pipeline_number,
+                body,
+                len(body),
+                stored_at or now,
+                now,
+            ),
+        )
+        if next(self._puts) % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def delete(self, key):
+        self._conn().execute("DELETE FROM responses WHERE name = ?", (key.name,))
+
+    def keys(self):
+        for kind, uuid, slug, num in self._conn().execute(
+            "SELECT kind, uuid, slug, pipeline_number FROM responses"
+        ):
+            yield CacheKey(kind, uuid, slug, num)
+
+    def evict(self):
+        conn = self._conn()
+        if self.max_age is not None:
+            conn.execute("DELETE FROM responses WHERE stored_at < ?", (time.time() - self.max_age,))
+        if self.max_bytes is not None:
+            # Drop least recently used rows until the newest ones fit in max_bytes.
+            row = conn.execute(
+                """
+                SELECT accessed_at FROM (
+                    SELECT accessed_at, SUM(size) OVER (ORDER BY accessed_at DESC) AS total
+                    FROM responses
+                ) WHERE total > ? ORDER BY accessed_at DESC LIMIT 1
+                """,
+                (self.max_bytes,),
+            ).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM responses WHERE accessed_at <= ?", row)
+
+    def stats(self):
+        count, size = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        return {"entries": count, "bytes": size}
+
+
+def open_cache(spec, max_bytes=None, max_age=None):
+    if spec.endswith(".db"):
+        return SQLiteCache(spec, max_bytes=max_bytes, max_age=max_age)
+    return FileCache(spec)
+
+
+def migrate_cache(src, dst):
+    n = 0
+    for key in src.keys():
+        found = src.get(key)
+        if found is None:
+            continue
+        j, _ = found
+        if isinstance(src, FileCache) and isinstance(dst, SQLiteCache):
+            dst.put(key, j, stored_at=os.path.getmtime(src._path(key)))
+        else:
+            dst.put(key, j)
+        n += 1
+    return n
+
+
+def _env_number(name):
+    return float(os.environ[name]) if os.environ.get(name) else None
+
+
+cache = open_cache(
+    os.environ.get("CIRCLECI_CACHE", "cache"),
+    max_bytes=_env_number("CIRCLECI_CACHE_MAX_BYTES"),
+    max_age=_env_number("CIRCLECI_CACHE_MAX_AGE"),
+)
+
+
+class MemoryCache:
+    # Parsed responses kept in process, evicted least recently used first once their total size
+    # passes max_bytes. Finished resources live for finished_ttl; anything that may still change
+    # (running workflows, pipeline listings) only for live_ttl.
+    def __init__(self, max_bytes=64 << 20, finished_ttl=86400, live_ttl=15):
+        self.max_bytes = max_bytes
+        self.finished_ttl = finished_ttl
+        self.live_ttl = live_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, j, size, finished):
+        if size > self.max_bytes:
+            return
+        expires = time.monotonic() + (self.finished_ttl if finished else self.live_ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires, size, j)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def peek(self, key):
+        # Like get, but without counting a hit or miss or refreshing the entry's position.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            return entry[2], entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+memory_cache = MemoryCache(
+    max_bytes=int(os.environ.get("CIRCLECI_MEMORY_CACHE_BYTES", 64 << 20)),
+    live_ttl=float(os.environ.get("CIRCLECI_LIVE_TTL", 15)),
+)
+
+
+for name, doc, kind, stats, key in [
+    (
+        "circleci_api_throttled_total",
+        "429 responses from the API.",
+        "counter",
+        limiter,
+        "throttled",
+    ),
+    (
+        "circleci_api_throttled_seconds_total",
+        "Time spent waiting for the rate limiter.",
+        "counter",
+        limiter,
+        "throttled_seconds",
+    ),
+    ("circleci_api_retries_total", "Retried API requests.", "counter", limiter, "retries"),
+    (
+        "circleci_api_retries_exhausted_total",
+        "API requests given up on after running out of retries.",
+        "counter",
+        limiter,
+        "retries_exhausted",
+    ),
+    ("circleci_api_in_flight", "API requests in flight.", "gauge", limiter, "in_flight"),
+    (
+        "circleci_rate_limit_concurrency",
+        "How many API requests may be in flight at once.",
+        "gauge",
+        limiter,
+        "concurrency_limit",
+    ),
+    ("circleci_rate_limit_rate", "API requests allowed per second.", "gauge", limiter, "rate"),
+    ("circleci_memory_cache_bytes", "Size of the memory cache.", "gauge", memory_cache, "bytes"),
+    ("circleci_memory_cache_entries", "Memory cache entries.", "gauge", memory_cache, "entries"),
+    ("circleci_memory_cache_hits_total", "Memory cache hits.", "counter", memory_cache, "hits"),
+    (
+        "circleci_memory_cache_misses_total",
+        "Memory cache misses.",
+        "counter",
+        memory_cache,
+        "misses",
+    ),
+    (
+        "circleci_memory_cache_evictions_total",
+        "Memory cache entries evicted for space.",
+        "counter",
+        memory_cache,
+        "evictions",
+    ),
+    (
+        "circleci_connections_total",
+        "Connections opened to the API.",
+        "counter",
+        transport,
+        "connections",
+    ),
+]:
+    metrics.Sampled(name, doc, kind, lambda stats=stats, key=key: stats.stats()[key])
+
+
+def memory_key(version, url, params):
+    return (version, url, tuple(sorted((k, v) for k, v in (params or {}).items() if v is not None)))
+
+
+def cache_load(mkey, key, max_age=None):
+    # max_age bounds how long ago a response on disk may have been stored.
+    j = memory_cache.get(mkey)
+    if j is not None:
+        return {CACHE_KEY: "memory", **j}
+    if key is None:
+        return None
+    found = cache.get(key, max_age)
+    if found is None:
+        return None
+    j, size = found
+    memory_cache.put(mkey, j, size, finished=True)
+    return {CACHE_KEY: "disk", **j}
+
+
+def cache_store(mkey, key, j, size, cache_filter=None):
+    finished = cache_filter(j) if cache_filter else key is not None
+    memory_cache.put(mkey, j, size, finished)
+    if key is not None and finished:
+        cache.put(key, j)
+
+
+API_CALLS = metrics.Counter(
+    "circleci_api_calls_total",
+    "API calls by endpoint and where their response came from: a cache tier, a concurrent "
+    'identical call ("coalesced") or the API itself ("api").',
+    ["endpoint", "source"],
+)
+
+
+def update_cached(url, item_id, fields, key=None, cache_filter=None):
+    # Apply fields pushed by a webhook to one item of a cached listing, and store the listing again
+    # so that one which is now finished is cached as such. Only first pages are looked at.
+    mkey = memory_key("2", url, None)
+    found = memory_cache.peek(mkey)
+    if found is None:
+        return False
+    j, size = found
+    for item in j["items"]:
+        if item["id"] == item_id:
+            item.update(fields)
+            break
+    else:
+        return False
+    cache_store(mkey, key, j, size, cache_filter)
+    return True
+
+
+class SingleFlight:
+    # Concurrent fetches of the same URL and params share one request: the first caller (the
+    # leader) makes it, and anyone asking meanwhile waits on its Future instead. Works across
+    # threads and event loops alike.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._coalesced = 0
+
+    def join(self, key):
+        # (future, leader); a leader must pass the outcome to `finish` or `abandon`.
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self._coalesced += 1
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def finish(self, key, future, result):
+        self._forget(key, future)
+        future.set_result(result)
+
+    def abandon(self, key, future, error):
+        # Errors are shared with the waiters; a leader that was itself interrupted (a cancelled
+        # task, Ctrl-C) cancels the future, and its waiters then go and fetch it themselves.
+        self._forget(key, future)
+        if isinstance(error, Exception):
+            future.set_exception(error)
+        else:
+            future.cancel()
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._calls), "coalesced": self._coalesced}
+
+
+inflight = SingleFlight()
+
+
+def auth_headers(headers):
+    if headers is None:
+        headers = {}
+    if token is None:
+        raise RuntimeError("set CIRCLECI_TOKEN to a CircleCI API token")
+    headers["Circle-Token"] = token
+    return headers
+
+
+def retry_after(response_headers):
+    try:
+        return max(0, int(response_headers["Retry-After"]))
+    except (KeyError, ValueError):
+        return None
 
 
 def api_get(
     url,
     *args,
     _version="2",
-    _cache_name=None,
+    _cache_key=None,
     _cache_filter=None,
+    _cache_max_age=None,
     headers=None,
     **kwargs,
 ):
-    fn = os.path.join("cache", _cache_name + ".json") if _cache_name else None
-    if fn and os.path.exists(fn):
-        with open(fn) as f:
-            return {CACHE_KEY: True, **json.load(f)}
-    if headers is None:
-        headers = {}
-    headers["Circle-Token"] = token
+    mkey = memory_key(_version, url, kwargs.get("params"))
+    while True:
+        j = cache_load(mkey, _cache_key, _cache_max_age)
+        if j is not None:
+            API_CALLS.inc(endpoint(url), j[CACHE_KEY])
+            return j
+        future, leader = inflight.join(mkey)
+        if leader:
+            break
+        try:
+            j = future.result()
+        except CancelledError:
+            continue
+        API_CALLS.inc(endpoint(url), "coalesced")
+        return {CACHE_KEY: "coalesced", **j}
 
+    try:
+        j, size = fetch(url, args, _version, headers, kwargs)
+        cache_store(mkey, _cache_key, j, size, _cache_filter)
+    except BaseException as e:
+        inflight.abandon(mkey, future, e)
+        raise
+    inflight.finish(mkey, future, j)
+    API_CALLS.inc(endpoint(url), "api")
+    return j
+
+
+def fetch(url, args, version, headers, kwargs):
+    headers = auth_headers(headers)
+    attempt = 0
     while True:
-        r = requests.get(
-            f"https://circleci.com/api/v{_version}/{url}", *args, headers=headers, **kwargs
-        )
+        started = limiter.acquire()
+        try:
+            r = transport.request(
+                "GET", f"{API_URL}/v{version}/{url}", *args, headers=headers, **kwargs
+            )
+        except BaseException:
+            limiter.release(started)
+            raise
+        delay = retry_after(r.headers)
+        limiter.release(started, r.status_code, delay)
 
         if r.ok:
-            j = r.json()
-            break
+            return r.json(), len(r.content)
 
-        if "Retry-After" in r.headers:
-            retry_after = int(r.headers["Retry-After"])
-            if retry_after > 0:
-                print(f"retrying {url} after {retry_after}")
-            time.sleep(retry_after)
-        else:
+        wait = limiter.retry_delay(attempt, r.status_code, delay)
+        if wait is None:
             r.raise_for_status()
-
-    if fn and (not _cache_filter or _cache_filter(j)):
-        with open(fn, "w") as f:
-            json.dump(j, f)
-    return j
+        print(f"retrying {url} ({r.status_code}) after {wait:.1f}s")
+        time.sleep(wait)
+        attempt += 1
 
 
 def api_post(url, *args, _version="2", headers=None, **kwargs):
-    if headers is None:
-        headers = {}
-    headers["Circle-Token"] = token
-    r = requests.post(
-        f"https://circleci.com/api/v{_version}/{url}", *args, headers=headers, **kwargs
-    )
+    headers = auth_headers(headers)
+    started = limiter.acquire()
+    status = None
+    try:
+        r = transport.request(
+            "POST", f"{API_URL}/v{_version}/{url}", *args, headers=headers, **kwargs
+        )
+        status = r.status_code
+    finally:
+        limiter.release(started, status, retry_after(r.headers) if status == 429 else None)
     return r.json()
 
 
+# Webhooks and the org-wide pipeline listing give slugs with the short VCS names.
+VCS_NAMES = {"gh": "github", "bb": "bitbucket"}
+
+
+def full_slug(slug):
+    vcs, _, rest = slug.partition("/")
+    return f"{VCS_NAMES.get(vcs, vcs)}/{rest}"
+
+
 def pipelines(org_slug, page_token=None):
     return api_get(
         "pipeline", params={"org-slug": org_slug, "page-token": page_token, "mine": "false"}
@@ -78,35 +954,131 @@ def project_pipelines(slug, branch, page_token=None):
     )
 
 
+# Rerunning a workflow adds a new one to its pipeline, however long ago the pipeline finished, so
+# a pipeline and its listing of workflows are only cached for good once it's been quiet this long.
+# Webhooks for a rerun's workflow drop the cached listing sooner (see record_workflow).
+rerun_window = float(os.environ.get("CIRCLECI_RERUN_WINDOW", 7 * 86400))
+# A rerun after that, with no webhook to say so, only shows once the cached listing is this old.
+settled_max_age = float(os.environ.get("CIRCLECI_SETTLED_MAX_AGE", 86400))
+
+PIPELINE_CREATED_STATES = {"created", "errored"}
+
+
+def quiet_since(t):
+    return t is not None and time.time() - t > rerun_window
+
+
+def pipeline_key(slug, num):
+    # Keyed by slug and number, which is how it's fetched; "+" can't appear in either.
+    return CacheKey("pipeline", f"{slug}/{num}".replace("/", "+"), slug, num)
+
+
+def pipeline_settled(r):
+    return r.get("state") in PIPELINE_CREATED_STATES and quiet_since(
+        parse_time(r.get("updated_at") or r["created_at"])
+    )
+
+
 def pipeline(slug, num):
-    return api_get(f"project/{slug}/pipeline/{num}")
+    return api_get(
+        f"project/{slug}/pipeline/{num}",
+        _cache_key=pipeline_key(slug, num),
+        _cache_filter=pipeline_settled,
+    )
+
+
+def workflow_finished(r):
+    return r["status"] in FINISHED_WORKFLOW_STATUSES
+
+
+def workflows_settled(r):
+    # An empty listing may just be one the pipeline hasn't got round to filling yet.
+    items = r["items"]
+    if not items or r.get("next_page_token") or not all(map(workflow_finished, items)):
+        return False
+    return quiet_since(max(parse_time(w.get("stopped_at") or w["created_at"]) for w in items))
 
 
-def pipeline_workflows(uuid, page_token=None):
+def pipeline_workflows(uuid, page_token=None, slug=None, pipeline_number=None):
     return api_get(
         f"pipeline/{uuid}/workflow",
         params={"page-token": page_token},
+        _cache_key=CacheKey("pipeline_workflows", uuid, slug, pipeline_number)
+        if page_token is None
+        else None,
+        _cache_filter=workflows_settled,
+        _cache_max_age=settled_max_age,
     )
 
 
 def workflow(uuid):
     return api_get(
         f"workflow/{uuid}",
-        _cache_name=f"workflow-{uuid}",
-        _cache_filter=lambda r: all(r["status"] in {"success", "failed", "canceled"}),
+        _cache_key=CacheKey("workflow", uuid),
+        _cache_filter=workflow_finished,
     )
 
 
-def workflow_jobs(uuid, page_token=None):
+FINISHED_JOB_STATUSES = {"success", "failed", "canceled"}
+
+
+def jobs_finished(r):
+    return all(j["status"] in FINISHED_JOB_STATUSES for j in r["items"])
+
+
+def workflow_jobs(uuid, page_token=None, slug=None, pipeline_number=None):
     return api_get(
         f"workflow/{uuid}/job",
         params={"page-token": page_token},
-        _cache_name=f"workflow_jobs-{uuid}",
-        _cache_filter=lambda r: all(
-            j["status"] in {"success", "failed", "canceled"} for j in r["items"]
-        ),
+        # The disk cache holds first pages only; it's keyed by workflow, not by page.
+        _cache_key=CacheKey("workflow_jobs", uuid, slug, pipeline_number)
+        if page_token is None
+        else None,
+        _cache_filter=jobs_finished,
+    )
+
+
+def record_workflow(pipeline_id, workflow_id, fields, slug=None, pipeline_number=None):
+    url = f"pipeline/{pipeline_id}/workflow"
+    key = CacheKey("pipeline_workflows", pipeline_id, slug, pipeline_number)
+    if update_cached(url, workflow_id, fields, key=key, cache_filter=workflows_settled):
+        return True
+    # Either the listing isn't in memory, or it predates this workflow: a rerun, re-opening the
+    # pipeline. Any copy of it (on disk, say, from before the rerun) is out of date either way.
+    memory_cache.discard(memory_key("2", url, None))
+    cache.delete(key)
+    return False
+
+
+def record_job(workflow_id, job_id, fields, slug=None, pipeline_number=None):
+    return update_cached(
+        f"workflow/{workflow_id}/job",
+        job_id,
+        fields,
+        key=CacheKey("workflow_jobs", workflow_id, slug, pipeline_number),
+        cache_filter=jobs_finished,
     )
 
 
 def workflow_rerun(uuid, jobs=[], from_failed=False):
     return api_post(f"workflow/{uuid}/rerun", json={"jobs": jobs, "from_failed": from_failed})
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate = subparsers.add_parser(
+        "migrate-cache", help="copy a cache/ directory of JSON files into a SQLite cache"
+    )
+    migrate.add_argument("src", nargs="?", default="cache")
+    migrate.add_argument("dst", nargs="?", default="cache.db")
+
+    args = parser.parse_args(args)
+
+    if args.command == "migrate-cache":
+        n = migrate_cache(FileCache(args.src), SQLiteCache(args.dst))
+        print(f"migrated {n} responses from {args.src} to {args.dst}")
+
+
+if __name__ == "__main__":
+    exit(main(sys.argv[1:]))
@@ -1,18 +1,30 @@
 # coding: pyxl
 
 import argparse
+import asyncio
+import atexit
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
+import math
+import multiprocessing
 import os
-import queue
-import re
+import secrets
 import sys
 import threading
 import time
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import NamedTuple, Optional
 
 from pyxl import html
+from pyxl.utils import escape
 
 import circleci
+import metrics
+from model import Pipeline, Row
 
 
 for name, attrs in [
@@ -46,16 +58,10 @@ def cached(enable, fn, func, *args, **kwargs):
 
     ret = func(*args, **kwargs)
 
-    with open(fn, "w") as f:
-        json.dump(ret, f)
+    circleci.atomic_write(fn, json.dumps(ret).encode())
     return ret
 
 
-def parse_time(s):
-    s = re.sub(r"(\.[0-9]+)?Z$", "", s)
-    return time.strptime(s, "%Y-%m-%dT%H:%M:%S")
-
-
 def format_duration(dt):
     h, m, s = dt // 3600, (dt % 3600) // 60, dt % 60
     return "{}:{:02}:{:02}".format(h, m, s) if h else "{}:{:02}".format(m, s)
@@ -80,32 +86,41 @@ class SVG:
 # fmt: on
 
 
-def proc(slug, pipelines, meta=None, description=None):
-    pipelines = [pipeline for pipeline_num, pipeline in sorted(pipelines.items(), reverse=True)]
+def fingerprint(pipelines):
+    # Changes whenever anything proc shows (other than the current time) does.
+    h = hashlib.sha256()
+    for num, p in sorted(pipelines.items()):
+        h.update(f"{num} {p.id}\n".encode())
+        for w in p.workflows:
+            h.update(f"{w.id} {w.status} {w.stopped}\n".encode())
+            for j in w.jobs:
+                h.update(f"{j.id} {j.status} {j.started} {j.stopped}\n".encode())
+    return h.hexdigest()
+
+
+def live(pipelines):
+    # Whether the rendering depends on the current time: how long running workflows have taken.
+    return any(w.duration is None for p in pipelines.values() for w in p.workflows)
+
 
-    # Expand out workflows with reruns into multiple copies of the pipeline,
-    # each containing all metadata but only workflows at a particular index.
-    pipelines2 = []
-    for p in pipelines:
-        for workflows in p["workflow_names"].values():
-            workflows.sort(key=lambda w: w["created_at"])
-        n = 1 if not p["workflow_names"] else max(map(len, p["workflow_names"].values()))
+def expand_reruns(pipelines):
+    # Expand out workflows with reruns into one row per rerun index, each showing the pipeline
+    # with only the workflows at that index.
+    rows = []
+    for num, p in sorted(pipelines.items(), reverse=True):
+        n = 1 if not p.workflow_names else max(map(len, p.workflow_names.values()))
         for i in reversed(range(n)):
-            p2 = dict(p)
-            p2["workflow_names"] = {
-                name: workflow[i]
-                for name, workflow in p["workflow_names"].items()
-                if i < len(workflow)
-            }
-            pipelines2.append(p2)
-            p2["rerun_index"] = i
-    pipelines = pipelines2
+            workflows = {name: ws[i] for name, ws in p.workflow_names.items() if i < len(ws)}
+            rows.append(Row(p, i, workflows))
+    return rows
 
+
+def workflow_structure(pipelines):
     structure = defaultdict(dict)
-    for p in pipelines:
-        for w in p["workflows"]:
-            for j in w["jobs"]:
-                structure[w["name"]][j["name"]] = None
+    for num, p in sorted(pipelines.items(), reverse=True):
+        for w in p.workflows:
+            for j in w.jobs:
+                structure[w.name][j.name] = None
 
     try:
         # Push nightly workflows to the end, or they'll flip back and forth depending on whether the
@@ -116,7 +131,10 @@ def proc(slug, pipelines, meta=None, description=None):
     except KeyError:
         pass
 
-    doc = <html></html>
+    return structure
+
+
+def render_head(slug, meta=None, description=None):
     style = """
     .rotated { vertical-align: top; transform: rotate(180deg); writing-mode: vertical-lr; min-width: 1em; }
     .icon { width: 24px; height: 24px; }
@@ -132,9 +150,9 @@ def proc(slug, pipelines, meta=None, description=None):
         </style>
         </head>
     )
-    body = <body></body>
+    preamble = []
     if title:
-        body.append(
+        preamble.append(
             <h1 style="margin-bottom: 0; text-align: center;">{title}</h1>
         )
 
@@ -143,11 +161,38 @@ def proc(slug, pipelines, meta=None, description=None):
         info_str += " ({}/{} uncached requests)".format(
             meta["uncached_requests"], meta["total_requests"]
         )
-    body.append(
+        if meta.get("coalesced"):
+            info_str += " ({} shared with concurrent loads)".format(meta["coalesced"])
+        if meta.get("loading"):
+            info_str += " ({} pipelines still loading)".format(len(meta["loading"]))
+        if "snapshot_at" in meta:
+            # A time rather than an age, since the page may be served again later.
+            fetched = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(meta["snapshot_at"]))
+            info_str += f" (data fetched at {fetched} GMT)"
+        if meta.get("hit_rates"):
+            info_str += " (cache hit rates: {})".format(
+                ", ".join(f"{task} {rate:.0%}" for task, rate in meta["hit_rates"].items())
+            )
+        if "memory_cache" in meta:
+            info_str += (
+                " (memory cache: {hits} hits, {misses} misses, {evictions} evictions)".format(
+                    **meta["memory_cache"]
+                )
+            )
+        if meta.get("rate_limiter", {}).get("throttled"):
+            info_str += (
+                " (rate limited {throttled} times, {throttled_seconds:.0f}s waiting)".format(
+                    **meta["rate_limiter"]
+                )
+            )
+    preamble.append(
         <div style="text-align: right;">{info_str}</div>
     )
 
-    table = <table></table>
+    return head, preamble
+
+
+def render_header_rows(structure):
     header = <tr></tr>
     header.append(<td></td>)
     header.append(<td></td>)
@@ -174,87 +219,252 @@ def proc(slug, pipelines, meta=None, description=None):
                 <td style="vertical-align: bottom; transform: rotate(45deg); transform-origin: bottom; padding-bottom: .5em;"><div style="white-space: nowrap;" class="rotated">{j}</div></td>
             )
 
-    table.append(header)
-    table.append(header2)
+    return header, header2
+
+
+def render_row(slug, structure, r):
+    pipeline = r.pipeline
+    row = <tr></tr>
+    if r.rerun_index > 0:
+        row.set_attr("style", "opacity: 0.5")
+    ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(pipeline.created))
+    branch = pipeline.ref
+    rev = pipeline.revision
+    rev_href = f"https://{slug.replace('github', 'github.com', 1)}/commit/{rev}"
+    title = pipeline.subject
+    row.append(
+        <td style="padding-right: .5em; white-space: nowrap;"><b>{ts}</b></td>
+    )
+    row.append(
+        <td style="padding-right: .5em;"><a href="{rev_href}" title="{title}"><tt>{rev[:8]}</tt> {branch}</a></td>
+    )
+
+    for i, (w, js) in enumerate(structure.items()):
+        if w not in r.workflow_names:
+            row.append(
+                <td class="spacer"></td>
+            )
+            row.append(
+                <td class="spacer"></td>
+            )
+        else:
+            workflow = r.workflow_names[w]
+
+            time_style = "font-size: 90%;"
+            duration = workflow.duration
+            if duration is None:
+                duration = int(time.time()) - workflow.created
+                time_style += "color: gray; font-style: italic;"
+
+            time_str = format_duration(duration)
+            timeline_href = f"workflow_timeline/{workflow.id}"
+            time_link = <a href="{timeline_href}">{time_str}</a>
+            workflow_href = f"https://app.circleci.com/pipelines/{slug}/{pipeline.number}/workflows/{workflow.id}"
+            row.append(
+                <td style="text-align: right; padding-left: 1em;" class="spacer"><span style="{time_style}">{time_link}</span></td>
+            )
+            row.append(
+                <td class="spacer"><a href="{workflow_href}" title="{w}">{SVG.logo}</a></td>
+            )
+
+        for j in js:
+            job = r.workflow_names[w].job_names.get(j) if w in r.workflow_names else None
+            stat = job.status if job else "—"
+            href = (
+                f"{workflow_href}/jobs/{job.number}"
+                if job and job.number is not None
+                else None
+            )
+            title = f"{j} ({stat})"
 
-    assert slug.startswith("github/")
+            if hasattr(SVG, stat):
+                stat = getattr(SVG, stat)
+            else:
+                stat = stat[:2]
+            if href is not None:
+                b = <a href={href}>{stat}</a>
+            else:
+                b = stat
 
-    for pipeline in pipelines:
-        row = <tr></tr>
-        if pipeline["rerun_index"] > 0:
-            row.set_attr("style", "opacity: 0.5")
-        ts = time.strftime("%Y-%m-%d %H:%M:%S", parse_time(pipeline["created_at"]))
-        branch = pipeline["vcs"].get("branch", pipeline["vcs"].get("tag", "???"))
-        rev = pipeline["vcs"]["revision"]
-        rev_href = f"https://{slug.replace('github', 'github.com', 1)}/commit/{rev}"
-        title = pipeline["vcs"].get("commit", {}).get("subject", "")
-        row.append(
-            <td style="padding-right: .5em; white-space: nowrap;"><b>{ts}</b></td>
+            if job and job.duration is not None:
+                title += ": " + format_duration(job.duration)
+            row.append(
+                <td style="text-align: center;"><span title="{title}">{b}</span></td>
+            )
+
+    return row
+
+
+class RowRenderer:
+    # Produces the same markup as render_row, but from pre-escaped fragments joined as strings
+    # rather than by building and serializing pyxl elements for every cell.
+    icons = {
+        name: str(getattr(SVG, name)) for name in vars(SVG) if not name.startswith("_")
+    }
+
+    def __init__(self, slug, structure):
+        self.rev_base = f"https://{slug.replace('github', 'github.com', 1)}/commit/"
+        self.workflow_base = escape(f"https://app.circleci.com/pipelines/{slug}/")
+        self.structure = [
+            (w, escape(w), [(j, escape(j)) for j in js]) for w, js in structure.items()
+        ]
+        self.statuses = {}
+
+    def status(self, stat):
+        # (escaped status, cell contents) for a job status; there are only a handful of those.
+        if stat not in self.statuses:
+            self.statuses[stat] = escape(stat), self.icons.get(stat) or escape(stat[:2])
+        return self.statuses[stat]
+
+    def pipeline_cells(self, pipeline):
+        ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(pipeline.created))
+        branch = pipeline.ref
+        rev = pipeline.revision
+        title = pipeline.subject
+        return (
+            f'<td style="padding-right: .5em; white-space: nowrap;"><b>{escape(ts)}</b></td>'
+            f'<td style="padding-right: .5em;"><a href="{escape(self.rev_base + rev)}" '
+            f'title="{escape(title)}"><tt>{escape(rev[:8])}</tt> {escape(branch)}</a></td>'
         )
-        row.append(
-            <td style="padding-right: .5em;"><a href="{rev_href}" title="{title}"><tt>{rev[:8]}</tt> {branch}</a></td>
+
+    def placeholder(self, pipeline):
+        # Stands in for a pipeline whose workflows a deferred crawl is still fetching; the page's
+        # script swaps it for the real rows, found by data-pipeline.
+        columns = sum(2 + len(js) for _, _, js in self.structure)
+        return (
+            f'<tr data-pipeline="{pipeline.number}">{self.pipeline_cells(pipeline)}'
+            f'<td colspan="{columns}" style="color: gray; font-style: italic;">loading…</td></tr>'
         )
 
-        for i, (w, js) in enumerate(structure.items()):
-            if w not in pipeline["workflow_names"]:
-                row.append(
-                    <td class="spacer"></td>
-                )
-                row.append(
-                    <td class="spacer"></td>
-                )
+    def render(self, row):
+        pipeline = row.pipeline
+        out = ['<tr style="opacity: 0.5">' if row.rerun_index > 0 else "<tr>"]
+        out.append(self.pipeline_cells(pipeline))
+
+        workflow_names = row.workflow_names
+        for w, w_html, js in self.structure:
+            workflow = workflow_names.get(w)
+            if workflow is None:
+                out.append('<td class="spacer"></td><td class="spacer"></td>')
+                job_names = {}
             else:
-                workflow = pipeline["workflow_names"][w]
-                t0 = time.mktime(parse_time(workflow["created_at"]))
-
                 time_style = "font-size: 90%;"
-                if workflow["stopped_at"]:
-                    t1 = time.mktime(parse_time(workflow["stopped_at"]))
-                else:
-                    t1 = time.mktime(time.gmtime())
+                duration = workflow.duration
+                if duration is None:
+                    duration = int(time.time()) - workflow.created
                     time_style += "color: gray; font-style: italic;"
-
-                time_str = format_duration(int(t1 - t0))
-                timeline_href = f"workflow_timeline/{workflow['id']}"
-                time_link = <a href="{timeline_href}">{time_str}</a>
-                workflow_href = f"https://app.circleci.com/pipelines/{slug}/{pipeline['number']}/workflows/{workflow['id']}"
-                row.append(
-                    <td style="text-align: right; padding-left: 1em;" class="spacer"><span style="{time_style}">{time_link}</span></td>
-                )
-                row.append(
-                    <td class="spacer"><a href="{workflow_href}" title="{w}">{SVG.logo}</a></td>
+                workflow_id = escape(workflow.id)
+                workflow_href = f"{self.workflow_base}{pipeline.number}/workflows/{workflow_id}"
+                out.append(
+                    '<td style="text-align: right; padding-left: 1em;" class="spacer">'
+                    '<span style="{}"><a href="workflow_timeline/{}">{}</a></span></td>'
+                    '<td class="spacer"><a href="{}" title="{}">{}</a></td>'.format(
+                        time_style,
+                        workflow_id,
+                        format_duration(duration),
+                        workflow_href,
+                        w_html,
+                        self.icons["logo"],
+                    )
                 )
+                job_names = workflow.job_names
+
+            for j, j_html in js:
+                job = job_names.get(j)
+                stat_html, b = self.status(job.status if job else "—")
+                title = f"{j_html} ({stat_html})"
+                if job:
+                    if job.number is not None:
+                        b = f'<a href="{workflow_href}/jobs/{job.number}">{b}</a>'
+                    if job.duration is not None:
+                        title += ": " + format_duration(job.duration)
+                out.append(f'<td style="text-align: center;"><span title="{title}">{b}</span></td>')
+
+        out.append("</tr>")
+        return "".join(out)
+
+
+RENDERERS = ("fast", "pyxl")
+
+
+def row_renderer(slug, structure, renderer, loading=()):
+    if renderer == "pyxl":
+        render = lambda row: render_row(slug, structure, row)
+    else:
+        render = RowRenderer(slug, structure).render
+    if not loading:
+        return render
+    placeholder = RowRenderer(slug, structure).placeholder
+    return lambda row: placeholder(row.pipeline) if row.pipeline.number in loading else render(row)
+
+
+# Polls rows/<id> for the pipelines still shown as placeholders, and puts each pipeline's rows in
+# place of its placeholder as they arrive. The endpoint holds each request until it has something.
+LOADING_SCRIPT = """<script>
+(function () {
+  function poll() {
+    var loading = Array.from(document.querySelectorAll("tr[data-pipeline]"), function (tr) {
+      return tr.dataset.pipeline;
+    });
+    if (!loading.length) return;
+    fetch("rows/%s?pipelines=" + loading.join(","))
+      .then(function (r) { if (!r.ok) throw new Error(r.status); return r.json(); })
+      .then(function (j) {
+        Object.keys(j.rows).forEach(function (num) {
+          var tr = document.querySelector('tr[data-pipeline="' + num + '"]');
+          tr.insertAdjacentHTML("beforebegin", j.rows[num]);
+          tr.remove();
+        });
+        // The finished crawl has jobs the page has no columns for.
+        if (j.reload) return location.reload();
+        if (!j.done || Object.keys(j.rows).length) poll();
+      }, function () {});
+  }
+  poll();
+})();
+</script>"""
+
+
+def loading_script(meta):
+    if meta is None or not meta.get("loading") or "deferred" not in meta:
+        return ""
+    return LOADING_SCRIPT % meta["deferred"]
+
+
+RENDER_SECONDS = metrics.Histogram(
+    "cisummary_render_seconds", "Time taken to render summary pages, by renderer.", ["renderer"]
+)
+
+
+def proc(slug, pipelines, meta=None, description=None, renderer="fast"):
+    with metrics.timed(RENDER_SECONDS, renderer, timing="render"):
+        return _proc(slug, pipelines, meta, description, renderer)
+
+
+def _proc(slug, pipelines, meta, description, renderer):
+    rows = expand_reruns(pipelines)
+    structure = workflow_structure(pipelines)
 
-            for j in js:
-                job = pipeline["workflow_names"].get(w, {}).get("job_names", {}).get(j)
-                stat = job["status"] if job else "—"
-                href = (
-                    f"{workflow_href}/jobs/{job['job_number']}"
-                    if job and "job_number" in job
-                    else None
-                )
-                title = f"{j} ({stat})"
+    doc = <html></html>
+    head, preamble = render_head(slug, meta=meta, description=description)
+    body = <body></body>
+    for element in preamble:
+        body.append(element)
 
-                if hasattr(SVG, stat):
-                    stat = getattr(SVG, stat)
-                else:
-                    stat = stat[:2]
-                if href is not None:
-                    b = <a href={href}>{stat}</a>
-                else:
-                    b = stat
-
-                if job and job.get("started_at") and job.get("stopped_at"):
-                    t0 = time.mktime(parse_time(job["started_at"]))
-                    t1 = time.mktime(parse_time(job["stopped_at"]))
-                    title += ": " + format_duration(int(t1 - t0))
-                row.append(
-                    <td style="text-align: center;"><span title="{title}">{b}</span></td>
-                )
+    table = <table></table>
+    for header in render_header_rows(structure):
+        table.append(header)
 
-        table.append(row)
+    assert slug.startswith("github/")
+
+    loading = set(meta.get("loading", ())) if meta is not None else set()
+    render = row_renderer(slug, structure, renderer, loading)
+    for row in rows:
+        row = render(row)
+        table.append(html.rawhtml(row) if isinstance(row, str) else row)
 
     body.append(table)
+    body.append(html.rawhtml(loading_script(meta)))
 
     doc.append(head)
     doc.append(body)
@@ -262,143 +472,1295 @@ def proc(slug, pipelines, meta=None, description=None):
     return doc
 
 
-def worker(in_q, out_q, slug, pipeline_filter, request_counter):
-    while True:
-        (task, args) = in_q.get()
-        if task is None:
-            in_q.task_done()
-            break
+def proc_stream(slug, pipelines, meta=None, description=None, renderer="fast"):
+    # The same document as proc, produced piecewise: everything up to the header rows first, then
+    # one table row at a time.
+    chunks = _proc_stream(slug, pipelines, meta, description, renderer)
+    return metrics.timed_iter(RENDER_SECONDS, chunks, renderer)
 
-        if task == "pipelines":
-            branch, page, token = args
-            pipelines = circleci.project_pipelines(slug, branch, page_token=token)
-            request_counter(pipelines.get(circleci.CACHE_KEY, False))
 
-            for pipeline in pipelines["items"]:
-                if pipeline_filter(pipeline):
-                    out_q.put(("pipeline", (pipeline,)))
-                    in_q.put(("pipeline_workflows", (pipeline,)))
+def _proc_stream(slug, pipelines, meta, description, renderer):
+    rows = expand_reruns(pipelines)
+    structure = workflow_structure(pipelines)
+
+    head, preamble = render_head(slug, meta=meta, description=description)
+    yield "".join(
+        ["<html>", str(head), "<body>"]
+        + [str(element) for element in preamble]
+        + ["<table>"]
+        + [str(header) for header in render_header_rows(structure)]
+    )
+
+    assert slug.startswith("github/")
+
+    loading = set(meta.get("loading", ())) if meta is not None else set()
+    render = row_renderer(slug, structure, renderer, loading)
+    for row in rows:
+        yield str(render(row))
+
+    yield "</table>" + loading_script(meta) + "</body></html>"
 
-            page -= 1
-            if page > 0:
-                in_q.put(("pipelines", (branch, page, pipelines["next_page_token"])))
 
+def render_overview_row(status):
+    slug = status.slug
+    repo_href = f"/{slug}/main"
+    row = <tr></tr>
+    row.append(
+        <td style="padding-right: 1em;"><b><a href="{repo_href}">{slug.split("/", 2)[-1]}</a></b></td>
+    )
+    pipeline = status.pipeline
+    if pipeline is None:
+        row.append(
+            <td colspan="2" style="color: gray; font-style: italic;">{status.error}</td>
+        )
+        return row
+
+    ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(pipeline.created))
+    rev = pipeline.revision
+    rev_href = f"https://{slug.replace('github', 'github.com', 1)}/commit/{rev}"
+    row.append(
+        <td style="padding-right: .5em; white-space: nowrap;">{ts}</td>
+    )
+    row.append(
+        <td style="padding-right: .5em;"><a href="{rev_href}" title="{pipeline.subject}"><tt>{rev[:8]}</tt></a></td>
+    )
+    for name, runs in pipeline.workflow_names.items():
+        # Only the latest rerun counts.
+        workflow = runs[-1]
+        time_style = "font-size: 90%;"
+        duration = workflow.duration
+        if duration is None:
+            duration = int(time.time()) - workflow.created
+            time_style += "color: gray; font-style: italic;"
+        icon = getattr(SVG, workflow.status, None) or workflow.status
+        workflow_href = f"https://app.circleci.com/pipelines/{slug}/{pipeline.number}/workflows/{workflow.id}"
+        timeline_href = f"/{slug}/workflow_timeline/{workflow.id}"
+        title = f"{name} ({workflow.status})"
+        row.append(
+            <td style="padding-left: 1em; white-space: nowrap;"><a href="{workflow_href}" title="{title}">{icon}</a> {name} <span style="{time_style}"><a href="{timeline_href}">{format_duration(duration)}</a></span></td>
+        )
+    return row
+
+
+def proc_overview(org_slug, statuses, meta=None, branch="main"):
+    doc = <html></html>
+    head, preamble = render_head(org_slug, meta=meta, description=f"latest on {branch}")
+    body = <body></body>
+    for element in preamble:
+        body.append(element)
+
+    table = <table></table>
+    for status in statuses:
+        table.append(render_overview_row(status))
+    body.append(table)
+
+    doc.append(head)
+    doc.append(body)
+
+    return doc
+
+
+class Cancelled(Exception):
+    pass
+
+
+def wait_event(event, cancelled, poll, timeout, cancel):
+    # Waits for `event`, checking `cancelled` every `poll` seconds and calling `cancel` once it's
+    # true. Returns False if `timeout` seconds pass first.
+    end = time.monotonic() + timeout if timeout is not None else None
+    while True:
+        wait = poll if cancelled else None
+        if end is not None:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return False
+            wait = remaining if wait is None else min(wait, remaining)
+        if event.wait(wait):
+            return True
+        if cancelled and cancelled():
+            cancel()
+
+
+class TaskGroup:
+    # The tasks belonging to one crawl. At most `limit` of them run on the shared pool at once; the
+    # rest wait here, lowest priority first, so a single request can't monopolize the executor.
+    def __init__(self, pool, limit):
+        self._pool = pool
+        self._limit = limit
+        self._lock = threading.Lock()
+        # (priority, sequence, fn, args); ties run in the order they were submitted.
+        self._pending = []
+        self._sequence = itertools.count()
+        self._running = 0
+        self._idle = threading.Event()
+        self._idle.set()
+        self._error = None
+        self.cancelled = False
+
+    def submit(self, fn, *args, priority=0):
+        with self._lock:
+            if self.cancelled:
+                return
+            heapq.heappush(self._pending, (priority, next(self._sequence), fn, args))
+            self._idle.clear()
+            self._dispatch()
+
+    def _dispatch(self):
+        while self._pending and self._running < self._limit:
+            _, _, fn, args = heapq.heappop(self._pending)
+            self._running += 1
+            self._pool.submit(self._run, fn, args)
+
+    def _run(self, fn, args):
+        try:
+            if not self.cancelled:
+                fn(*args)
+        except BaseException as e:
+            with self._lock:
+                if self._error is None:
+                    self._error = e
+            self.cancel()
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._dispatch()
+                if not self._running and not self._pending:
+                    self._idle.set()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            self._pending.clear()
+            if not self._running:
+                self._idle.set()
+
+    def wait(self, cancelled=None, poll=0.5, timeout=None):
+        # Returns False if `timeout` seconds pass first, leaving the tasks running.
+        if not wait_event(self._idle, cancelled, poll, timeout, self.cancel):
+            return False
+        if self._error is not None:
+            raise self._error
+        if self.cancelled:
+            raise Cancelled()
+        return True
+
+
+class FetchExecutor:
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="fetch")
+        circleci.transport.resize(max_workers)
+
+    def group(self, limit=None):
+        return TaskGroup(self._pool, min(limit or self.max_workers, self.max_workers))
+
+
+executor = FetchExecutor(int(os.environ.get("CISUMMARY_FETCHERS", 64)))
+
+# "threads" runs crawls on `executor`; "async" runs each crawl as coroutines on its own event loop,
+# with up to `async_concurrency` requests in flight.
+ENGINES = ("threads", "async")
+default_engine = os.environ.get("CISUMMARY_ENGINE", "threads")
+async_concurrency = int(os.environ.get("CISUMMARY_ASYNC_CONCURRENCY", 256))
+
+default_incremental = os.environ.get("CISUMMARY_INCREMENTAL", "") == "1"
+
+
+# A pipeline with no workflows this long after creation isn't going to get any.
+SETTLE_SECONDS = 3600
+
+
+def pipeline_finished(pipeline, workflows):
+    if not workflows:
+        age = time.time() - circleci.parse_time(pipeline["created_at"])
+        return pipeline.get("state") == "errored" or age > SETTLE_SECONDS
+    return all(w["status"] in circleci.FINISHED_WORKFLOW_STATUSES for w in workflows)
+
+
+class SyncState:
+    # What previous crawls of one slug and branch have already seen, so the next one only has to
+    # fetch what's new or unfinished.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.high_water = 0
+        # Pipelines as listed by project_pipelines, newest first, whether or not they passed the
+        # filter of the crawl that saw them.
+        self.listing = []
+        # For the last pipeline of each fetched page, the token for the page after it.
+        self.page_tokens = {}
+        self.tail_token = None
+        self.max_entries = 0
+        self.workflows = {}
+        self.jobs = {}
+        # Workflows whose jobs were fetched after the workflow had finished, so won't change.
+        self.settled_jobs = set()
+        self.unfinished = set()
+
+    def snapshot(self):
+        with self.lock:
+            known = SyncState()
+            known.high_water = self.high_water
+            known.listing = list(self.listing)
+            known.page_tokens = dict(self.page_tokens)
+            known.tail_token = self.tail_token
+            known.workflows = dict(self.workflows)
+            known.jobs = dict(self.jobs)
+            known.settled_jobs = set(self.settled_jobs)
+            known.unfinished = set(self.unfinished)
+            return known
+
+    def update(self, crawl):
+        with self.lock:
+            listing = crawl.listing + crawl.listing_tail
+            self.high_water = max([self.high_water] + [p["number"] for p in listing])
+            self.page_tokens.update(crawl.page_tokens)
+            self.tail_token = crawl.tail_token
+            self.max_entries = max(self.max_entries, crawl.wanted)
+
+            # Keep as many pipelines as the deepest crawl has asked for, cutting at a page boundary
+            # so later crawls can carry on from there.
+            if len(listing) > self.max_entries:
+                for i in range(self.max_entries, len(listing)):
+                    token = self.page_tokens.get(listing[i - 1]["number"])
+                    if token:
+                        listing = listing[:i]
+                        self.tail_token = token
+                        break
+            self.listing = listing
+
+            for pipeline in crawl.pipelines_map.values():
+                if pipeline["id"] not in crawl.workflows_map:
+                    continue
+                workflows = crawl.workflows_map[pipeline["id"]]
+                self.workflows[pipeline["id"]] = workflows
+                for w in workflows:
+                    self.jobs[w["id"]] = crawl.jobs_map[w["id"]]
+                    if w["id"] in crawl.settled_jobs:
+                        self.settled_jobs.add(w["id"])
+                    else:
+                        self.settled_jobs.discard(w["id"])
+                if pipeline_finished(pipeline, workflows) and all(
+                    w["id"] in self.settled_jobs for w in workflows
+                ):
+                    self.unfinished.discard(pipeline["number"])
+                else:
+                    self.unfinished.add(pipeline["number"])
+
+            listed = {p["number"] for p in listing}
+            listed_ids = {p["id"] for p in listing}
+            self.page_tokens = {n: t for n, t in self.page_tokens.items() if n in listed}
+            self.unfinished &= listed
+            for pipeline_id in set(self.workflows) - listed_ids:
+                for w in self.workflows.pop(pipeline_id):
+                    self.jobs.pop(w["id"], None)
+                    self.settled_jobs.discard(w["id"])
+
+    def record(self, pipeline_id, pipeline_number, workflow_id, fields, job_id=None):
+        # Apply a webhook's update to a workflow (or, given job_id, one of its jobs) that an
+        # earlier crawl kept, and let the next crawl reuse its pipeline if that's now finished.
+        with self.lock:
+            workflows = self.workflows.get(pipeline_id)
+            if workflows is None:
+                return False
+            if job_id is None:
+                items, item_id = workflows, workflow_id
+            else:
+                items, item_id = self.jobs.get(workflow_id, ()), job_id
+            item = next((x for x in items if x["id"] == item_id), None)
+            if item is None:
+                # Most likely a rerun the earlier crawl didn't see; have the next one refetch it.
+                self.unfinished.add(pipeline_number)
+                return False
+            item.update(fields)
+            for w in workflows:
+                jobs = self.jobs.get(w["id"])
+                if (
+                    w["status"] in circleci.FINISHED_WORKFLOW_STATUSES
+                    and jobs is not None
+                    and all(j["status"] in circleci.FINISHED_JOB_STATUSES for j in jobs)
+                ):
+                    self.settled_jobs.add(w["id"])
+            pipeline = next((p for p in self.listing if p["id"] == pipeline_id), None)
+            if (
+                pipeline is not None
+                and pipeline_finished(pipeline, workflows)
+                and all(w["id"] in self.settled_jobs for w in workflows)
+            ):
+                self.unfinished.discard(pipeline_number)
+            return True
+
+
+sync_states = {}
+sync_states_lock = threading.Lock()
+
+
+def sync_state(slug, branch):
+    with sync_states_lock:
+        return sync_states.setdefault((slug, branch), SyncState())
+
+
+WEBHOOK_FIELDS = {
+    "workflow-completed": ("status", "stopped_at"),
+    "job-completed": ("status", "started_at", "stopped_at"),
+}
+
+
+class EventUpdate(NamedTuple):
+    pipeline_id: str
+    pipeline_number: int
+    workflow_id: str
+    # None for a workflow-completed webhook.
+    job_id: Optional[str]
+    fields: dict
+
+
+def event_update(event):
+    # What a workflow-completed or job-completed webhook changes; KeyError or TypeError if the
+    # payload lacks any of it.
+    kind = event["type"]
+    pipeline = event["pipeline"]
+    if kind == "workflow-completed":
+        job_id, item = None, event["workflow"]
+    else:
+        job_id, item = event["job"]["id"], event["job"]
+    fields = {k: item[k] for k in WEBHOOK_FIELDS[kind]}
+    return EventUpdate(pipeline["id"], pipeline["number"], event["workflow"]["id"], job_id, fields)
+
+
+def apply_event(slug, update):
+    # Push a webhook's update into the cached records that crawls read, so they're current without
+    # refetching. Returns how many cached records were updated.
+    if update.job_id is None:
+        updated = circleci.record_workflow(
+            update.pipeline_id, update.workflow_id, update.fields, slug, update.pipeline_number
+        )
+    else:
+        updated = circleci.record_job(
+            update.workflow_id, update.job_id, update.fields, slug, update.pipeline_number
+        )
+    with sync_states_lock:
+        states = [state for (s, _), state in sync_states.items() if s == slug]
+    for state in states:
+        updated += state.record(
+            update.pipeline_id,
+            update.pipeline_number,
+            update.workflow_id,
+            update.fields,
+            update.job_id,
+        )
+    return updated
+
+
+CRAWL_REQUESTS = metrics.Histogram(
+    "cisummary_crawl_requests",
+    "API calls made by each crawl, cached ones included.",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500),
+)
+CRAWL_DEPTH = metrics.Histogram(
+    "cisummary_crawl_depth",
+    "The longest chain of API calls in each crawl that had to wait on one another.",
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20),
+)
+
+
+class Crawl:
+    # The pipelines -> workflows -> jobs crawl, independent of what runs the requests: `request`
+    # names the API call a task needs and `handle` takes its response and returns follow-up tasks.
+    #
+    # With a SyncState, pagination stops at the first page that reaches pipelines an earlier crawl
+    # has listed, and of those only the unfinished ones have their workflows fetched again.
+    def __init__(self, slug, branch, pages, pipeline_filter, state=None):
+        self.slug = slug
+        self.branch = branch
+        self.pages = pages
+        self.pipeline_filter = pipeline_filter
+        self.state = state
+        self.known = state.snapshot() if state is not None else None
+        self.pipelines_map = {}
+        self.workflows_map = {}
+        self.jobs_map = {}
+        self.settled_jobs = set()
+        self.listing = []
+        self.listing_tail = []
+        self.page_tokens = {}
+        self.tail_token = None
+        self.wanted = 0
+        self.spliced = False
+        self.total_requests = 0
+        self.uncached_requests = 0
+        self.coalesced = 0
+        self.cache_hits = Counter()
+        # By task: how many requests there were, and how many of them a cache (or a concurrent
+        # identical request) answered.
+        self.task_requests = Counter()
+        self.task_hits = Counter()
+        self.reused_pipelines = 0
+        self.depth = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        return [("pipelines", (self.branch, self.pages, None))]
+
+    def request(self, task, args):
+        if task == "pipelines":
+            branch, page, token = args
+            return "project_pipelines", (self.slug, branch), {"page_token": token}
         elif task == "pipeline_workflows":
             (pipeline,) = args
-            workflows = circleci.pipeline_workflows(pipeline["id"])
-            request_counter(workflows.get(circleci.CACHE_KEY, False))
-
-            out_q.put(("pipeline_workflows", (pipeline, workflows["items"])))
-            for workflow in workflows["items"]:
-                in_q.put(("workflow_jobs", (workflow,)))
+            return (
+                "pipeline_workflows",
+                (pipeline["id"],),
+                {"slug": self.slug, "pipeline_number": pipeline["number"]},
+            )
+        elif task == "workflow_jobs":
+            (workflow,) = args
+            return (
+                "workflow_jobs",
+                (workflow["id"],),
+                {"slug": self.slug, "pipeline_number": workflow.get("pipeline_number")},
+            )
+        raise ValueError(task)
 
+    def priority(self, task, args):
+        # Lower runs first: the listing's pages, so every pipeline at least gets a row, then the
+        # workflows and jobs of the newest pipelines, which are the ones people are waiting on.
+        if task == "pipelines":
+            return -math.inf
+        elif task == "pipeline_workflows":
+            (pipeline,) = args
+            return -pipeline["number"]
         elif task == "workflow_jobs":
             (workflow,) = args
-            jobs = circleci.workflow_jobs(workflow["id"])
-            request_counter(jobs.get(circleci.CACHE_KEY, False))
-            out_q.put(("workflow_jobs", (workflow, jobs["items"])))
+            return -(workflow.get("pipeline_number") or 0)
+        raise ValueError(task)
+
+    def _add_pipeline(self, pipeline):
+        if not self.pipeline_filter(pipeline):
+            return []
+        self.pipelines_map[pipeline["number"]] = pipeline
+
+        known = self.known
+        if (
+            known is not None
+            and pipeline["id"] in known.workflows
+            and pipeline["number"] not in known.unfinished
+        ):
+            workflows = known.workflows[pipeline["id"]]
+            self.workflows_map[pipeline["id"]] = workflows
+            for w in workflows:
+                self.jobs_map[w["id"]] = known.jobs[w["id"]]
+                self.settled_jobs.add(w["id"])
+            self.reused_pipelines += 1
+            return []
+        return [("pipeline_workflows", (pipeline,))]
+
+    def _handle_pipelines(self, args, response):
+        branch, page, token = args
+        items = response["items"]
+        next_token = response["next_page_token"]
+        if not self.wanted:
+            self.wanted = page * len(items)
+
+        new_tasks = []
+        self.listing.extend(items)
+        for pipeline in items:
+            new_tasks.extend(self._add_pipeline(pipeline))
+        if items:
+            self.page_tokens[items[-1]["number"]] = next_token
+        self.tail_token = next_token
+        page -= 1
+
+        known = self.known
+        if (
+            known is not None
+            and not self.spliced
+            and any(p["number"] <= known.high_water for p in items)
+        ):
+            # Everything after this page is already in the previous listing.
+            self.spliced = True
+            oldest = items[-1]["number"] if items else known.high_water + 1
+            rest = [p for p in known.listing if p["number"] < oldest]
+            wanted = max(0, self.wanted - len(self.listing))
+            for pipeline in rest[:wanted]:
+                new_tasks.extend(self._add_pipeline(pipeline))
+            self.listing.extend(rest[:wanted])
+            self.listing_tail = rest[wanted:]
+            self.tail_token = known.tail_token
+            shortfall = self.wanted - len(self.listing)
+            page = -(-shortfall // len(items)) if shortfall > 0 and items else 0
+            next_token = known.tail_token
+
+        if page > 0 and next_token:
+            new_tasks.append(("pipelines", (branch, page, next_token)))
+        return new_tasks
+
+    def handle(self, task, args, response):
+        new_tasks = []
+        with self._lock:
+            self.total_requests += 1
+            tier = response.get(circleci.CACHE_KEY, False)
+            self.task_requests[task] += 1
+            self.task_hits[task] += bool(tier)
+            if tier == "coalesced":
+                # Shared another caller's in-flight request.
+                self.coalesced += 1
+            elif tier:
+                self.cache_hits[tier] += 1
+            else:
+                self.uncached_requests += 1
+
+            if task == "pipelines":
+                new_tasks = self._handle_pipelines(args, response)
+
+            elif task == "pipeline_workflows":
+                (pipeline,) = args
+                self.workflows_map[pipeline["id"]] = response["items"]
+                known = self.known
+                for workflow in response["items"]:
+                    # Jobs fetched while the workflow was running may have changed since.
+                    if (
+                        known is not None
+                        and workflow["status"] in circleci.FINISHED_WORKFLOW_STATUSES
+                        and workflow["id"] in known.settled_jobs
+                    ):
+                        self.jobs_map[workflow["id"]] = known.jobs[workflow["id"]]
+                        self.settled_jobs.add(workflow["id"])
+                    else:
+                        new_tasks.append(("workflow_jobs", (workflow,)))
+
+            elif task == "workflow_jobs":
+                (workflow,) = args
+                self.jobs_map[workflow["id"]] = response["items"]
+                if workflow["status"] in circleci.FINISHED_WORKFLOW_STATUSES:
+                    self.settled_jobs.add(workflow["id"])
+
+        return new_tasks
+
+    def reached(self, depth):
+        with self._lock:
+            self.depth = max(self.depth, depth)
+
+    def pipeline(self, num):
+        # The pipeline once its workflows and all their jobs have arrived, else None.
+        with self._lock:
+            pipeline = self.pipelines_map.get(num)
+            workflows = self.workflows_map.get(pipeline["id"]) if pipeline is not None else None
+            if workflows is None or any(w["id"] not in self.jobs_map for w in workflows):
+                return None
+            return Pipeline.from_api(pipeline, workflows, self.jobs_map)
+
+    def has_complete_pipeline(self):
+        # Whether any pipeline with workflows has arrived in full, giving a page columns to show.
+        with self._lock:
+            for pipeline in self.pipelines_map.values():
+                workflows = self.workflows_map.get(pipeline["id"])
+                if workflows and all(w["id"] in self.jobs_map for w in workflows):
+                    return True
+            return False
+
+    def partial_result(self):
+        # What has arrived so far, for a crawl that's still running: pipelines missing workflows
+        # or jobs come without any workflows, and are listed newest first in meta["loading"].
+        with self._lock:
+            listed = list(self.pipelines_map.items())
+            meta = self._meta()
+        pipelines_map = {}
+        loading = []
+        for num, pipeline in listed:
+            pipelines_map[num] = self.pipeline(num)
+            if pipelines_map[num] is None:
+                pipelines_map[num] = Pipeline.from_api(pipeline, [], {})
+                loading.append(num)
+        meta["loading"] = sorted(loading, reverse=True)
+        return pipelines_map, meta
+
+    def result(self):
+        if self.state is not None:
+            self.state.update(self)
+        CRAWL_REQUESTS.observe(self.total_requests)
+        CRAWL_DEPTH.observe(self.depth)
+
+        # The raw records stay shared with the sync state and caches; views get the compact model.
+        pipelines_map = {
+            num: Pipeline.from_api(pipeline, self.workflows_map[pipeline["id"]], self.jobs_map)
+            for num, pipeline in self.pipelines_map.items()
+        }
+
+        return pipelines_map, self._meta()
+
+    def _meta(self):
+        return {
+            "total_requests": self.total_requests,
+            "uncached_requests": self.uncached_requests,
+            "coalesced": self.coalesced,
+            "cache_hits": dict(self.cache_hits),
+            "hit_rates": {
+                task: self.task_hits[task] / n for task, n in sorted(self.task_requests.items())
+            },
+            "memory_cache": circleci.memory_cache.stats(),
+            "rate_limiter": circleci.limiter.stats(),
+            "reused_pipelines": self.reused_pipelines,
+            "depth": self.depth,
+        }
+
+
+def submit_task(group, crawl, task, args, depth=1):
+    priority = crawl.priority(task, args)
+    group.submit(run_task, group, crawl, task, args, depth, priority=priority)
 
-        in_q.task_done()
 
+def run_task(group, crawl, task, args, depth=1):
+    name, call_args, call_kwargs = crawl.request(task, args)
+    response = getattr(circleci, name)(*call_args, **call_kwargs)
+    crawl.reached(depth)
+    for new_task, new_args in crawl.handle(task, args, response):
+        submit_task(group, crawl, new_task, new_args, depth + 1)
 
-def proc_all(pipelines):
-    def go(pipeline_filter, fn):
-        doc = proc({num: p for num, p in pipelines.items() if pipeline_filter(p)})
-        with open(fn, "w") as f:
-            print(doc, file=f)
 
-    go(lambda p: p["vcs"].get("branch") == "master", "ci-master.html")
-    go(lambda p: p["vcs"].get("branch", "").startswith("pull/"), "ci-pulls.html")
-    go(lambda p: "tag" in p["vcs"], "ci-tags.html")
-    go(lambda p: True, "ci-all.html")
+async def crawl_async(crawl, concurrency, cancelled=None, poll=0.5):
+    import aiocircleci
 
+    tasks = set()
+    # Like TaskGroup's queue: (priority, sequence, task, args, depth), started `concurrency` at a
+    # time.
+    pending = []
+    sequence = itertools.count()
+
+    def submit(task, args, depth=1):
+        heapq.heappush(pending, (crawl.priority(task, args), next(sequence), task, args, depth))
+
+    async def run_task_async(task, args, depth):
+        name, call_args, call_kwargs = crawl.request(task, args)
+        response = await getattr(aiocircleci, name)(*call_args, **call_kwargs)
+        crawl.reached(depth)
+        for new_task, new_args in crawl.handle(task, args, response):
+            submit(new_task, new_args, depth + 1)
+
+    async with aiocircleci.client(limit=concurrency):
+        for task, args in crawl.start():
+            submit(task, args)
+        try:
+            while pending or tasks:
+                while pending and len(tasks) < concurrency:
+                    _, _, task, args, depth = heapq.heappop(pending)
+                    tasks.add(asyncio.ensure_future(run_task_async(task, args, depth)))
+                done, _ = await asyncio.wait(
+                    set(tasks),
+                    timeout=poll if cancelled else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                tasks.difference_update(done)
+                for t in done:
+                    t.result()
+                if cancelled and cancelled():
+                    raise Cancelled()
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class AsyncCrawl:
+    # crawl_async on an event loop of its own thread, so that like a TaskGroup it can be waited on
+    # for a while and then left to finish in the background.
+    def __init__(self, crawl, concurrency):
+        self.cancelled = False
+        self._error = None
+        self._done = threading.Event()
+        threading.Thread(target=self._run, args=(crawl, concurrency), daemon=True).start()
+
+    def _run(self, crawl, concurrency):
+        try:
+            asyncio.run(crawl_async(crawl, concurrency, cancelled=lambda: self.cancelled))
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._done.set()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def wait(self, cancelled=None, poll=0.5, timeout=None):
+        # `cancelled` is checked here rather than on the crawl's thread, since it may need the
+        # waiting thread's context (e.g. serv.py's client_disconnected).
+        if not wait_event(self._done, cancelled, poll, timeout, self.cancel):
+            return False
+        if self._error is not None:
+            raise self._error
+        return True
+
+
+SNAPSHOT_VERSION = 1
+
+
+def snapshot_path(root, slug, view):
+    return os.path.join(root, slug, f"{view}.json.gz")
+
+
+def write_snapshot(path, pipelines, meta, written_at):
+    body = json.dumps(
+        {
+            "version": SNAPSHOT_VERSION,
+            "written_at": written_at,
+            "meta": meta,
+            "pipelines": [p.to_json() for num, p in sorted(pipelines.items(), reverse=True)],
+        },
+        separators=(",", ":"),
+    ).encode()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    circleci.atomic_write(path, gzip.compress(body, compresslevel=5))
+
+
+def read_snapshot(path):
+    with open(path, "rb") as f:
+        j = json.loads(gzip.decompress(f.read()))
+    if j.get("version") != SNAPSHOT_VERSION:
+        return None
+    pipelines = {p.number: p for p in map(Pipeline.from_json, j["pipelines"])}
+    return pipelines, j["meta"], j["written_at"]
+
+
+class SnapshotStore:
+    # One compressed snapshot per slug and view under root. Writes happen on a background thread,
+    # which only ever writes the newest pending snapshot for a file; reads are memoized by mtime.
+    def __init__(self, root):
+        self.root = root
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._writing = False
+        self._thread = None
+        self._loaded = {}
+
+    def save(self, slug, view, pipelines, meta):
+        # Resolved now: the writer thread may run after the working directory has changed.
+        path = os.path.abspath(snapshot_path(self.root, slug, view))
+        with self._cond:
+            self._pending[path] = (pipelines, meta, time.time())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                path, item = self._pending.popitem()
+                self._writing = True
+            try:
+                write_snapshot(path, *item)
+            except Exception as e:
+                print(f"writing snapshot {path} failed: {e!r}")
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+    def flush(self):
+        with self._cond:
+            while self._pending or self._writing:
+                self._cond.wait()
+
+    def load(self, slug, view):
+        # (pipelines, meta, written_at), or None if there's no usable snapshot.
+        path = snapshot_path(self.root, slug, view)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        loaded = self._loaded.get(path)
+        if loaded is None or loaded[0] != mtime:
+            loaded = self._loaded[path] = (mtime, read_snapshot(path))
+        return loaded[1]
+
+
+snapshots = SnapshotStore(os.environ.get("CISUMMARY_SNAPSHOTS", "snapshots"))
+atexit.register(snapshots.flush)
+
+
+class Deferred:
+    # A crawl get_data stopped waiting for at its deadline. It carries on in the background, and
+    # deferred_rows renders the pipelines it was still fetching once they arrive, with the columns
+    # of the page that showed them as placeholders.
+    def __init__(self, slug, crawl, structure):
+        self.slug = slug
+        self.crawl = crawl
+        self.structure = structure
+        # The columns of all the crawl's pipelines, once it has finished.
+        self.final_structure = None
+        self.done = threading.Event()
+        self.finished_at = None
+
+    def columns_changed(self):
+        # Whether the finished crawl has jobs the page had no columns for.
+        final = self.final_structure
+        return final is not None and any(
+            job not in self.structure.get(name, ()) for name, jobs in final.items() for job in jobs
+        )
+
+    def finish(self):
+        self.finished_at = time.time()
+        self.done.set()
+
+
+class DeferredCrawls:
+    # Deferred crawls by a random id, kept for max_age seconds after they finish.
+    def __init__(self, max_age=300, max_entries=256):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._crawls = {}
+        self._lock = threading.Lock()
+
+    def add(self, deferred):
+        crawl_id = secrets.token_urlsafe(12)
+        with self._lock:
+            now = time.time()
+            for k, d in list(self._crawls.items()):
+                if d.finished_at is not None and now - d.finished_at > self.max_age:
+                    del self._crawls[k]
+            while len(self._crawls) >= self.max_entries:
+                del self._crawls[next(iter(self._crawls))]
+            self._crawls[crawl_id] = deferred
+        return crawl_id
+
+    def get(self, crawl_id):
+        with self._lock:
+            return self._crawls.get(crawl_id)
+
+
+deferred_crawls = DeferredCrawls()
+
+
+def finish_deferred(deferred, runner, view):
+    try:
+        runner.wait()
+    except Exception as e:
+        print(f"deferred crawl of {deferred.slug} failed: {e!r}")
+    else:
+        pipelines_map, meta = deferred.crawl.result()
+        deferred.final_structure = workflow_structure(pipelines_map)
+        snapshots.save(deferred.slug, view, pipelines_map, meta)
+    finally:
+        deferred.finish()
+
+
+def deferred_rows(deferred, numbers, renderer="fast", wait=2.0):
+    # ({number: rows' HTML} for those of `numbers` whose pipelines have arrived, whether the crawl
+    # is over), waiting up to `wait` seconds for there to be any. Jobs whose names weren't among
+    # the page's columns aren't shown.
+    end = time.monotonic() + wait
+    while True:
+        done = deferred.done.is_set()
+        arrived = {num: deferred.crawl.pipeline(num) for num in numbers}
+        arrived = {num: p for num, p in arrived.items() if p is not None}
+        remaining = end - time.monotonic()
+        if arrived or done or remaining <= 0:
+            break
+        deferred.done.wait(min(remaining, 0.1))
+
+    render = row_renderer(deferred.slug, deferred.structure, renderer)
+    rows = {
+        num: "".join(str(render(row)) for row in expand_reruns({num: p}))
+        for num, p in arrived.items()
+    }
+    return rows, done
+
+
+GET_DATA_SECONDS = metrics.Histogram(
+    "cisummary_get_data_seconds",
+    "Time taken to load a view's pipelines, by whether they came from a crawl or a snapshot.",
+    ["source"],
+)
+
+
+def get_data(
+    slug,
+    branch,
+    pages=None,
+    cached=False,
+    jobs=32,
+    pipeline_filter=lambda p: True,
+    cancelled=None,
+    engine=None,
+    incremental=None,
+    view=None,
+    deadline=None,
+):
+    # With a deadline (in seconds), a crawl that takes longer is left running and what it has
+    # fetched so far is returned; see Crawl.partial_result. meta["deferred"] then names it for
+    # deferred_rows.
+    if view is None:
+        view = branch or "all"
 
-def get_data(slug, branch, pages=None, cached=False, jobs=32, pipeline_filter=lambda p: True):
     if cached:
-        with open("all-cache.json") as f:
-            return json.load(f)
+        with metrics.timed(GET_DATA_SECONDS, "snapshot", timing="snapshot"):
+            loaded = snapshots.load(slug, view)
+        if loaded is not None:
+            pipelines_map, meta, written_at = loaded
+            return pipelines_map, dict(meta, snapshot_at=written_at)
 
     if pages is None:
         pages = 8 if branch is None else 2
 
-    pipelines_map = {}
-    workflows_map = {}
-    jobs_map = {}
-
-    in_q = queue.Queue()
-    out_q = queue.Queue()
-
-    total_requests = 0
-    uncached_requests = 0
-    lock = threading.Lock()
-
-    def request_counter(cached):
-        nonlocal total_requests, uncached_requests
-        with lock:
-            total_requests += 1
-            if not cached:
-                uncached_requests += 1
-
-    in_q.put(("pipelines", (branch, pages, None)))
-    for _ in range(jobs):
-        t = threading.Thread(
-            target=worker,
-            args=(in_q, out_q),
-            kwargs={
-                "slug": slug,
-                "pipeline_filter": pipeline_filter,
-                "request_counter": request_counter,
-            },
+    if incremental is None:
+        incremental = default_incremental
+    state = sync_state(slug, branch) if incremental else None
+
+    with metrics.timed(GET_DATA_SECONDS, "crawl", timing="crawl"):
+        crawl = Crawl(slug, branch, pages, pipeline_filter, state=state)
+        if (engine or default_engine) == "async":
+            runner = AsyncCrawl(crawl, async_concurrency)
+        else:
+            runner = executor.group(jobs)
+            for task, args in crawl.start():
+                submit_task(runner, crawl, task, args)
+
+        finished = runner.wait(cancelled=cancelled, timeout=deadline)
+        # Placeholders need the columns of at least one pipeline to fit in (and a listing to come
+        # from), so the deadline is only kept once there's one.
+        while not finished and not crawl.has_complete_pipeline():
+            finished = runner.wait(cancelled=cancelled, poll=0.05, timeout=0.05)
+        if not finished:
+            pipelines_map, meta = crawl.partial_result()
+            deferred = Deferred(slug, crawl, workflow_structure(pipelines_map))
+            meta["deferred"] = deferred_crawls.add(deferred)
+            threading.Thread(
+                target=finish_deferred, args=(deferred, runner, view), daemon=True
+            ).start()
+            return pipelines_map, meta
+
+        pipelines_map, meta = crawl.result()
+    snapshots.save(slug, view, pipelines_map, meta)
+    return pipelines_map, meta
+
+
+class RepoStatus(NamedTuple):
+    slug: str
+    # The latest pipeline with workflows, without their jobs.
+    pipeline: Optional[Pipeline] = None
+    error: Optional[str] = None
+
+
+# Pipelines per repo to look through for one that has workflows.
+OVERVIEW_CANDIDATES = 3
+
+overview_deadline = float(os.environ.get("CISUMMARY_OVERVIEW_DEADLINE", 10))
+
+
+class Overview:
+    # The latest pipeline on `branch` of each of an org's slugs. They're looked for in the org-wide
+    # pipeline listing first, so only quiet repos need listing on their own, and every repo's
+    # requests go through one task group and so share its fetch budget. A repo's own work starts
+    # as soon as the listing turns up a candidate for it, or once the listing is over if it
+    # doesn't; each repo then has `deadline` seconds from then.
+    def __init__(self, org_slug, slugs, branch, pages, pipeline_filter, deadline):
+        self.org_slug = org_slug
+        self.slugs = slugs
+        self.branch = branch
+        self.pages = pages
+        self.pipeline_filter = pipeline_filter
+        self.deadline = deadline
+        self.candidates = {slug: [] for slug in slugs}
+        self.results = {}
+        # When each repo's own work started, by time.monotonic().
+        self.started = {}
+        self.listing_started = time.monotonic()
+        self.total_requests = 0
+        self.uncached_requests = 0
+        self._lock = threading.Lock()
+
+    def _count(self, response):
+        with self._lock:
+            self.total_requests += 1
+            if not response.get(circleci.CACHE_KEY):
+                self.uncached_requests += 1
+
+    def _wanted(self, slug, pipeline):
+        return pipeline.get("vcs", {}).get("branch") == self.branch and self.pipeline_filter(
+            slug, pipeline
         )
-        t.daemon = True
-        t.start()
 
-    in_q.join()
+    def _start(self, group, slug):
+        with self._lock:
+            if slug in self.started:
+                return
+            self.started[slug] = time.monotonic()
+        group.submit(self.latest, group, slug)
 
-    while True:
+    def list_org(self, group, page, token):
         try:
-            task, ret = out_q.get_nowait()
-        except queue.Empty:
-            break
-        if task == "pipeline":
-            (pipeline,) = ret
-            pipelines_map[pipeline["number"]] = pipeline
-        elif task == "pipeline_workflows":
-            pipeline, workflows = ret
-            workflows_map[pipeline["id"]] = workflows
-        elif task == "workflow_jobs":
-            workflow, jobs = ret
-            jobs_map[workflow["id"]] = jobs
-
-    for num, pipeline in pipelines_map.items():
-        pipeline["workflows"] = workflows_map[pipeline["id"]]
-        pipeline["workflow_names"] = {}
-        for w in workflows_map[pipeline["id"]]:
-            pipeline["workflow_names"].setdefault(w["name"], []).append(w)
-        for workflow in pipeline["workflows"]:
-            workflow["jobs"] = jobs_map[workflow["id"]]
-            workflow["job_names"] = {j["name"]: j for j in jobs_map[workflow["id"]]}
-
-    with open("all-cache.json", "w") as f:
-        json.dump(pipelines_map, f, indent=2)
-
-    return pipelines_map, {
-        "total_requests": total_requests,
-        "uncached_requests": uncached_requests,
-    }
+            r = circleci.pipelines(self.org_slug, page_token=token)
+            self._count(r)
+        except Exception as e:
+            print(f"listing {self.org_slug} failed: {e!r}")
+            r = {"items": [], "next_page_token": None}
+        for pipeline in r["items"]:
+            slug = circleci.full_slug(pipeline.get("project_slug", ""))
+            if slug in self.candidates and self._wanted(slug, pipeline):
+                self.candidates[slug].append(pipeline)
+                self._start(group, slug)
+        # The next pages only save quiet repos a listing of their own, so they don't get to hold
+        # those repos up for longer than a repo's deadline.
+        listing_time = time.monotonic() - self.listing_started
+        if page > 1 and r["next_page_token"] and listing_time < self.deadline:
+            # Ahead of the repos' own requests, which the later pages might spare.
+            group.submit(self.list_org, group, page - 1, r["next_page_token"], priority=-1)
+            return
+        for slug in self.slugs:
+            self._start(group, slug)
+
+    def latest(self, group, slug):
+        try:
+            # The listing may still be adding candidates to the list while this goes through it.
+            candidates = self.candidates[slug]
+            if not candidates:
+                r = circleci.project_pipelines(slug, self.branch)
+                self._count(r)
+                candidates = [p for p in r["items"] if self._wanted(slug, p)]
+            for pipeline in itertools.islice(candidates, OVERVIEW_CANDIDATES):
+                r = circleci.pipeline_workflows(pipeline["id"])
+                self._count(r)
+                if r["items"]:
+                    jobs_map = {w["id"]: [] for w in r["items"]}
+                    status = RepoStatus(slug, Pipeline.from_api(pipeline, r["items"], jobs_map))
+                    break
+            else:
+                status = RepoStatus(slug, error=f"no recent pipelines on {self.branch}")
+        except Exception as e:
+            status = RepoStatus(slug, error=f"failed: {e!r}")
+        with self._lock:
+            self.results[slug] = status
+
+    def wait(self, group):
+        # Waits for every repo that's still within its deadline, and cancels the rest. A repo the
+        # listing hasn't got to yet is due to start once the listing's own deadline is up.
+        listing_end = self.listing_started + self.deadline
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                ends = [
+                    self.started.get(slug, listing_end) + self.deadline
+                    for slug in self.slugs
+                    if slug not in self.results
+                ]
+            ends = [end for end in ends if end > now]
+            if not ends:
+                group.cancel()
+                return
+            if group.wait(timeout=min(ends) - now):
+                return
+
+
+def get_overview(
+    org_slug,
+    slugs,
+    branch="main",
+    pages=2,
+    jobs=16,
+    deadline=None,
+    pipeline_filter=lambda slug, p: True,
+):
+    # One RepoStatus per slug, in the given order. A repo that isn't done `deadline` seconds after
+    # its work started is shown as timed out rather than holding up the rest.
+    if deadline is None:
+        deadline = overview_deadline
+    overview = Overview(org_slug, slugs, branch, pages, pipeline_filter, deadline)
+    group = executor.group(jobs)
+    group.submit(overview.list_org, group, pages, None, priority=-1)
+    overview.wait(group)
+
+    with overview._lock:
+        results = dict(overview.results)
+        meta = {
+            "total_requests": overview.total_requests,
+            "uncached_requests": overview.uncached_requests,
+        }
+    timed_out = RepoStatus("", error=f"timed out after {deadline:g}s")
+    return [results.get(slug) or timed_out._replace(slug=slug) for slug in slugs], meta
+
+
+# The static site: for each slug, <slug>/<view>.html and a gzipped .html.gz next to it, from a
+# single crawl of all its branches, plus an index.html of them all. A manifest of each page's data
+# fingerprint lets later runs skip pages whose data hasn't changed; such pages keep showing the
+# durations of running workflows as of when they were written.
+SITE_VERSION = 1
+SITE_VIEWS = ("pulls", "tags", "all")
+
+
+def site_filter(view, branch):
+    if view == "pulls":
+        return lambda p: (p.branch or "").startswith("pull/")
+    elif view == "tags":
+        return lambda p: p.tag is not None
+    elif view == "all":
+        return lambda p: True
+    return lambda p: p.branch == branch
+
+
+def page_hash(*parts):
+    return hashlib.sha256(" ".join(map(str, (SITE_VERSION,) + parts)).encode()).hexdigest()
+
+
+def write_page(path, body):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    circleci.atomic_write(path, body)
+    # mtime=0 keeps the .gz the same for the same page, for hosts that compare contents.
+    circleci.atomic_write(path + ".gz", gzip.compress(body, compresslevel=9, mtime=0))
+
+
+def render_page(path, slug, view, pipelines, meta):
+    # Runs in generate_site's worker processes.
+    write_page(path, "".join(proc_stream(slug, pipelines, meta, description=view)).encode())
+    return path
+
+
+def proc_index(slugs, views):
+    items = []
+    for slug in slugs:
+        s = escape(slug)
+        links = " ".join(f'<a href="{s}/{escape(v)}.html">{escape(v)}</a>' for v in views)
+        items.append(f"<li><b>{s}</b>: {links}</li>")
+    body = "".join(items)
+    return f"<html><head><title>CI summary</title></head><body><ul>{body}</ul></body></html>"
+
+
+def generate_site(
+    slugs,
+    out,
+    branch="main",
+    pages=8,
+    cached=False,
+    jobs=32,
+    engine=None,
+    ignored=None,
+    processes=None,
+    crawls=4,
+    force=False,
+):
+    # Crawls up to `crawls` slugs at a time and renders their pages on `processes` processes as
+    # each crawl finishes. Returns how many pages were written, left alone, and failed.
+    ignored = ignored or {}
+    views = (branch,) + SITE_VIEWS
+    manifest_path = os.path.join(out, "manifest.json")
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {}
+    stats = Counter()
+
+    def crawl(slug):
+        return get_data(
+            slug,
+            None,
+            pages=pages,
+            cached=cached,
+            jobs=jobs,
+            engine=engine,
+            pipeline_filter=lambda p: p["number"] not in ignored.get(slug, ()),
+        )
+
+    def unchanged(name, h):
+        path = os.path.join(out, name)
+        return (
+            not force
+            and manifest.get(name) == h
+            and os.path.exists(path)
+            and os.path.exists(path + ".gz")
+        )
+
+    # Forked from a single-threaded server process, never from this one, which is crawling.
+    pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("forkserver"))
+    renders = {}
+    with pool, ThreadPoolExecutor(crawls, thread_name_prefix="site") as crawler:
+        crawled = {crawler.submit(crawl, slug): slug for slug in slugs}
+        for future in as_completed(crawled):
+            slug = crawled[future]
+            try:
+                data, meta = future.result()
+            except Exception as e:
+                print(f"crawling {slug} failed: {e!r}")
+                stats["failed"] += len(views)
+                continue
+            for view in views:
+                keep = site_filter(view, branch)
+                pipelines = {n: p for n, p in data.items() if keep(p)}
+                name = os.path.join(slug, f"{view}.html")
+                h = page_hash(slug, view, fingerprint(pipelines))
+                if unchanged(name, h):
+                    stats["unchanged"] += 1
+                    continue
+                path = os.path.join(out, name)
+                renders[pool.submit(render_page, path, slug, view, pipelines, meta)] = (name, h)
+
+        for future in as_completed(renders):
+            name, h = renders[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"rendering {name} failed: {e!r}")
+                stats["failed"] += 1
+                manifest.pop(name, None)
+            else:
+                stats["written"] += 1
+                manifest[name] = h
+
+    h = page_hash("index", *slugs, *views)
+    if not unchanged("index.html", h):
+        write_page(os.path.join(out, "index.html"), proc_index(slugs, views).encode())
+        manifest["index.html"] = h
+    os.makedirs(out, exist_ok=True)
+    circleci.atomic_write(manifest_path, json.dumps(manifest, indent=1, sort_keys=True).encode())
+    return dict(stats)
 
 
 def main(args):
     parser = argparse.ArgumentParser()
-    parser.add_argument("branch", default=None, nargs="?")
-    parser.add_argument("--pages", type=int, default=None)
-    parser.add_argument("--cached", action="store_true")
+    parser.add_argument("slugs", nargs="*", help="default: those in --allowed-slugs")
+    parser.add_argument("-o", "--out", default="site")
+    parser.add_argument("--allowed-slugs", default="allowed_slugs.json")
+    parser.add_argument("--ignored-pipelines", default="ignored_pipelines.json")
+    parser.add_argument("--branch", default="main", help="the branch with a page of its own")
+    parser.add_argument("--pages", type=int, default=8)
+    parser.add_argument("--cached", action="store_true", help="render the last crawl's snapshots")
     parser.add_argument("-J", "--jobs", type=int, default=32)
+    parser.add_argument("--engine", choices=ENGINES, default=None)
+    parser.add_argument("-P", "--processes", type=int, default=None, help="default: one per core")
+    parser.add_argument("--crawls", type=int, default=4, help="slugs crawled at once")
+    parser.add_argument("--force", action="store_true", help="rewrite unchanged pages too")
 
     args = parser.parse_args(args)
 
-    pipelines, _ = get_data(args.branch, pages=args.pages, cached=args.cached, jobs=args.jobs)
-    proc_all(pipelines)
+    slugs = args.slugs
+    if not slugs:
+        with open(args.allowed_slugs) as f:
+            slugs = sorted(json.load(f))
+    try:
+        with open(args.ignored_pipelines) as f:
+            ignored = {slug: set(nums) for slug, nums in json.load(f).items()}
+    except FileNotFoundError:
+        ignored = {}
+
+    t0 = time.monotonic()
+    stats = generate_site(
+        slugs,
+        args.out,
+        branch=args.branch,
+        pages=args.pages,
+        cached=args.cached,
+        jobs=args.jobs,
+        engine=args.engine,
+        ignored=ignored,
+        processes=args.processes,
+        crawls=args.crawls,
+        force=args.force,
+    )
+    print(
+        f"{len(slugs)} slugs in {time.monotonic() - t0:.1f}s: {stats.get('written', 0)} pages "
+        f"written, {stats.get('unchanged', 0)} unchanged, {stats.get('failed', 0)} failed"
+    )
+    return 1 if stats.get("failed") else 0
 
 
 if __name__ == "__main__":
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+# A stand-in for the parts of the CircleCI v2 API used by circleci.py, serving a synthetic project
+# so crawls can be run and timed without a token.
+
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+NAMESPACE = uuid.UUID("6b0b5a5e-2a8e-4f61-9a43-3c0b7d1d0a11")
+PAGE_SIZE = 20
+T0 = 1600000000
+
+
+def make_id(*parts):
+    return str(uuid.uuid5(NAMESPACE, "/".join(map(str, parts))))
+
+
+def iso(t):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
+
+
+class FakeOrg:
+    # rerun_ratio of the finished pipelines have every workflow failed and then rerun successfully.
+    def __init__(self, slugs, pipelines=100, workflows=3, jobs=20, running=2, rerun_ratio=0.0):
+        self.rerun_ratio = rerun_ratio
+        self.pipelines = {}
+        self.pipelines_by_id = {}
+        self.workflows = {}
+        self.jobs = {}
+        for slug in slugs:
+            items = []
+            for num in range(pipelines, 0, -1):
+                p = self._pipeline(slug, num, workflows, jobs, running=pipelines - num < running)
+                items.append(p)
+            self.pipelines[slug] = items
+
+    def _pipeline(self, slug, num, n_workflows, n_jobs, running):
+        created = T0 + num * 600
+        kind = num % 4
+        if kind == 3:
+            vcs = {"tag": f"v0.{num}.0"}
+        elif kind == 2:
+            vcs = {"branch": f"pull/{num}"}
+        else:
+            vcs = {"branch": "main"}
+        vcs["revision"] = make_id(slug, num).replace("-", "")
+        vcs["commit"] = {"subject": f"commit {num}"}
+        p = {
+            "id": make_id(slug, num),
+            "number": num,
+            "project_slug": slug,
+            "created_at": iso(created),
+            "state": "created",
+            "vcs": vcs,
+        }
+        self.pipelines_by_id[p["id"]] = p
+        # Seeded by the pipeline, so the same arguments always give the same org.
+        rerun = not running and random.Random(p["id"]).random() < self.rerun_ratio
+        workflows = []
+        for i in range(n_workflows):
+            if running:
+                status = "running"
+            elif rerun or num % 7 == 0:
+                status = "failed"
+            else:
+                status = "success"
+            workflows.append(self._workflow(p, i, created, n_jobs, running, status))
+            if rerun:
+                workflows.append(
+                    self._workflow(p, i, created + 400, n_jobs, False, "success", attempt=1)
+                )
+        self.workflows[p["id"]] = workflows
+        return p
+
+    def _workflow(self, p, i, created, n_jobs, running, status, attempt=0):
+        slug, num = p["project_slug"], p["number"]
+        # Reruns get ids of their own; first runs keep the same ids whatever rerun_ratio is.
+        rerun = (attempt,) if attempt else ()
+        w = {
+            "id": make_id(slug, num, i, *rerun),
+            "name": f"workflow-{i}",
+            "pipeline_id": p["id"],
+            "pipeline_number": num,
+            "project_slug": slug,
+            "created_at": iso(created),
+            "stopped_at": None if running else iso(created + 300),
+            "status": status,
+        }
+        jobs = []
+        for k in range(n_jobs):
+            done = not running or k < n_jobs // 2
+            jobs.append(
+                {
+                    "id": make_id(slug, num, i, k, *rerun),
+                    "name": f"job-{k}",
+                    "job_number": num * 1000 + i * 100 + k + attempt * 50,
+                    "project_slug": slug,
+                    "status": ("success" if done else "running"),
+                    "started_at": iso(created + k * 10),
+                    "stopped_at": iso(created + k * 10 + 60) if done else None,
+                    "dependencies": [jobs[-1]["id"]] if k else [],
+                    "type": "build",
+                }
+            )
+        self.jobs[w["id"]] = jobs
+        return w
+
+
+def paginate(items, token):
+    start = int(token or 0)
+    end = start + PAGE_SIZE
+    return {"items": items[start:end], "next_page_token": str(end) if end < len(items) else None}
+
+
+class Bucket:
+    # The API's rate limit, as a token bucket refilled at `rate` requests per second.
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        # 0 if the request is allowed, else the Retry-After to send back.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            self.rejected += 1
+            return max(1, math.ceil((1 - self.tokens) / self.rate))
+
+
+def make_handler(org, latency, bucket=None, throttle_ratio=0.0):
+    # Besides the bucket's 429s, throttle_ratio of all requests get one without a Retry-After, as
+    # the API sometimes sends when it's overloaded.
+    throttle = random.Random(0)
+    throttle_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+            if bucket is not None:
+                retry_after = bucket.take()
+                if retry_after:
+                    self.send_response(429)
+                    self.send_header("Retry-After", str(retry_after))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+            if throttle_ratio:
+                with throttle_lock:
+                    throttled = throttle.random() < throttle_ratio
+                if throttled:
+                    self.send_response(429)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+            u = urlparse(self.path)
+            q = {k: v[0] for k, v in parse_qs(u.query).items()}
+            parts = u.path.strip("/").split("/")[2:]
+            body = self.route(parts, q)
+            if body is None:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def route(self, parts, q):
+            token = q.get("page-token")
+            if parts[0] == "project" and parts[-1] == "pipeline":
+                slug = "/".join(parts[1:4])
+                items = org.pipelines.get(slug, [])
+                if q.get("branch"):
+                    items = [p for p in items if p["vcs"].get("branch") == q["branch"]]
+                return paginate(items, token)
+            if parts[0] == "project" and parts[-2] == "pipeline":
+                slug = "/".join(parts[1:4])
+                for p in org.pipelines.get(slug, []):
+                    if p["number"] == int(parts[-1]):
+                        return p
+                return None
+            if parts[0] == "pipeline" and len(parts) == 1:
+                items = sorted(
+                    (p for ps in org.pipelines.values() for p in ps),
+                    key=lambda p: p["created_at"],
+                    reverse=True,
+                )
+                return paginate(items, token)
+            if parts[0] == "pipeline" and parts[-1] == "workflow":
+                return paginate(org.workflows.get(parts[1], []), token)
+            if parts[0] == "workflow" and len(parts) == 3 and parts[2] == "job":
+                return paginate(org.jobs.get(parts[1], []), token) if parts[1] in org.jobs else None
+            if parts[0] == "workflow" and len(parts) == 2:
+                for ws in org.workflows.values():
+                    for w in ws:
+                        if w["id"] == parts[1]:
+                            return w
+            return None
+
+    return Handler
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-response (e.g. a cancelled crawl) are expected.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def serve(slugs, port=0, **kwargs):
+    latency = kwargs.pop("latency", 0)
+    rate_limit = kwargs.pop("rate_limit", None)
+    burst = kwargs.pop("burst", None)
+    throttle_ratio = kwargs.pop("throttle_ratio", 0.0)
+    bucket = Bucket(rate_limit, burst) if rate_limit else None
+    org = FakeOrg(slugs, **kwargs)
+    server = Server(("127.0.0.1", port), make_handler(org, latency, bucket, throttle_ratio))
+    server.bucket = bucket
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    return server, org
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("slugs", nargs="+")
+    parser.add_argument("-p", "--port", type=int, default=8081)
+    parser.add_argument("--pipelines", type=int, default=100)
+    parser.add_argument("--workflows", type=int, default=3)
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=None, help="requests per second")
+    parser.add_argument("--burst", type=int, default=None)
+    parser.add_argument("--rerun-ratio", type=float, default=0.0)
+    parser.add_argument("--throttle-ratio", type=float, default=0.0)
+
+    args = parser.parse_args(args)
+
+    server, _ = serve(
+        args.slugs,
+        port=args.port,
+        pipelines=args.pipelines,
+        workflows=args.workflows,
+        jobs=args.jobs,
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        burst=args.burst,
+        rerun_ratio=args.rerun_ratio,
+        throttle_ratio=args.throttle_ratio,
+    )
+    print(f"serving fake API on http://127.0.0.1:{server.server_port}/api")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    exit(main(sys.argv[1:]))
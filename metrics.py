@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# Process-wide counters and histograms, rendered in the Prometheus text format by serv.py's
+# /metrics. Modules define the metrics for their own hot paths at import time.
+
+import bisect
+import contextlib
+import threading
+import time
+
+# Seconds, from a cache hit to a slow crawl.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+metrics = []
+
+
+def escape_label(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in pairs) + "}"
+
+
+def format_value(v):
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        metrics.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, v in values:
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {format_value(v)}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (not cumulative), +Inf count, sum]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(labels)
+            if v is None:
+                v = self._values[labels] = [[0] * len(self.buckets), 0, 0.0]
+            if i < len(self.buckets):
+                v[0][i] += 1
+            else:
+                v[1] += 1
+            v[2] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, (list(v[0]), v[1], v[2])) for labels, v in self._values.items()]
+        for labels, (counts, inf, total) in sorted(values):
+            n = 0
+            for le, count in zip(self.buckets, counts):
+                n += count
+                le_label = format_labels(self.labelnames, labels, [("le", format_value(le))])
+                yield f"{self.name}_bucket{le_label} {n}"
+            n += inf
+            inf_label = format_labels(self.labelnames, labels, [("le", "+Inf")])
+            yield f"{self.name}_bucket{inf_label} {n}"
+            label_str = format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_str} {format_value(total)}"
+            yield f"{self.name}_count{label_str} {n}"
+
+
+class Sampled(Metric):
+    # A value read when the metrics are rendered, for things already counted elsewhere (e.g. by a
+    # stats() method). `fn` returns a number, or with labelnames a dict of label tuples to numbers.
+    def __init__(self, name, help, type, fn, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.type = type
+        self.fn = fn
+
+    def samples(self):
+        v = self.fn()
+        values = sorted(v.items()) if self.labelnames else [((), v)]
+        for labels, value in values:
+            if value is not None:
+                yield f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}"
+
+
+def render():
+    return "".join(m.render() for m in metrics)
+
+
+# Per-request breakdowns for serv.py's Server-Timing header: while a thread is collecting, `timed`
+# also records how long each named phase took on it.
+_local = threading.local()
+
+
+def start_timings():
+    _local.timings = []
+
+
+def stop_timings():
+    timings = getattr(_local, "timings", None)
+    _local.timings = None
+    return timings
+
+
+def record_timing(name, seconds):
+    timings = getattr(_local, "timings", None)
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+@contextlib.contextmanager
+def timed(histogram, *labels, timing=None):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        histogram.observe(elapsed, *labels)
+        if timing is not None:
+            record_timing(timing, elapsed)
+
+
+def timed_iter(histogram, chunks, *labels, timing=None):
+    # Like `timed` around producing each chunk, observing the total once they run out; time the
+    # consumer spends between chunks isn't counted.
+    elapsed = 0.0
+    it = iter(chunks)
+    try:
+        while True:
+            t0 = time.perf_counter()
+            try:
+                chunk = next(it)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - t0
+            yield chunk
+    finally:
+        if hasattr(it, "close"):
+            it.close()
+    histogram.observe(elapsed, *labels)
+    if timing is not None:
+        record_timing(timing, elapsed)
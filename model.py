@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+# Compact records for what the summary and timeline views show, built once from the API's JSON.
+# Only the fields the views use are kept, times are epoch seconds, and names, statuses and branches
+# are interned, since the same few strings repeat across thousands of jobs.
+
+import sys
+from typing import Dict, NamedTuple
+
+import circleci
+
+intern = sys.intern
+
+
+def intern_opt(s):
+    return intern(s) if s is not None else None
+
+
+class Job:
+    __slots__ = (
+        "id",
+        "name",
+        "number",
+        "status",
+        "started",
+        "stopped",
+        "duration",
+        "dependencies",
+    )
+
+    def __init__(self, id, name, number, status, started, stopped, dependencies=()):
+        self.id = id
+        self.name = name
+        self.number = number
+        self.status = status
+        self.started = started
+        self.stopped = stopped
+        self.duration = stopped - started if started and stopped else None
+        self.dependencies = dependencies
+
+    @classmethod
+    def from_api(cls, j):
+        return cls(
+            j["id"],
+            intern(j["name"]),
+            j.get("job_number"),
+            intern(j["status"]),
+            circleci.parse_time(j.get("started_at")),
+            circleci.parse_time(j.get("stopped_at")),
+            # Shared with the response rather than copied; only the timeline reads these.
+            j.get("dependencies") or (),
+        )
+
+    def to_json(self):
+        return [self.id, self.name, self.number, self.status, self.started, self.stopped]
+
+    @classmethod
+    def from_json(cls, j):
+        id, name, number, status, started, stopped = j
+        return cls(id, intern(name), number, intern(status), started, stopped)
+
+
+class Workflow:
+    __slots__ = ("id", "name", "status", "created", "stopped", "duration", "jobs", "job_names")
+
+    def __init__(self, id, name, status, created, stopped, jobs):
+        self.id = id
+        self.name = name
+        self.status = status
+        self.created = created
+        self.stopped = stopped
+        # None while the workflow is still running.
+        self.duration = stopped - created if stopped is not None else None
+        self.jobs = jobs
+        self.job_names = {j.name: j for j in jobs}
+
+    @classmethod
+    def from_api(cls, w, jobs):
+        return cls(
+            w["id"],
+            intern(w["name"]),
+            intern(w["status"]),
+            circleci.parse_time(w["created_at"]),
+            circleci.parse_time(w["stopped_at"]),
+            [Job.from_api(j) for j in jobs],
+        )
+
+    def to_json(self):
+        return [
+            self.id,
+            self.name,
+            self.status,
+            self.created,
+            self.stopped,
+            [j.to_json() for j in self.jobs],
+        ]
+
+    @classmethod
+    def from_json(cls, j):
+        id, name, status, created, stopped, jobs = j
+        jobs = list(map(Job.from_json, jobs))
+        return cls(id, intern(name), intern(status), created, stopped, jobs)
+
+
+class Pipeline:
+    __slots__ = (
+        "id",
+        "number",
+        "created",
+        "branch",
+        "tag",
+        "revision",
+        "subject",
+        "workflows",
+        "workflow_names",
+    )
+
+    def __init__(self, id, number, created, branch, tag, revision, subject, workflows):
+        self.id = id
+        self.number = number
+        self.created = created
+        self.branch = branch
+        self.tag = tag
+        self.revision = revision
+        self.subject = subject
+        self.workflows = workflows
+        # Reruns show up as several workflows with the same name, oldest first.
+        self.workflow_names = {}
+        for w in sorted(workflows, key=lambda w: w.created):
+            self.workflow_names.setdefault(w.name, []).append(w)
+
+    @property
+    def ref(self):
+        if self.branch is not None:
+            return self.branch
+        return self.tag if self.tag is not None else "???"
+
+    @classmethod
+    def from_api(cls, p, workflows, jobs_map):
+        vcs = p["vcs"]
+        return cls(
+            p["id"],
+            p["number"],
+            circleci.parse_time(p["created_at"]),
+            intern_opt(vcs.get("branch")),
+            vcs.get("tag"),
+            vcs["revision"],
+            vcs.get("commit", {}).get("subject", ""),
+            [Workflow.from_api(w, jobs_map[w["id"]]) for w in workflows],
+        )
+
+    def to_json(self):
+        return [
+            self.id,
+            self.number,
+            self.created,
+            self.branch,
+            self.tag,
+            self.revision,
+            self.subject,
+            [w.to_json() for w in self.workflows],
+        ]
+
+    @classmethod
+    def from_json(cls, j):
+        id, number, created, branch, tag, revision, subject, workflows = j
+        workflows = list(map(Workflow.from_json, workflows))
+        return cls(id, number, created, intern_opt(branch), tag, revision, subject, workflows)
+
+
+class Row(NamedTuple):
+    # One table row: a pipeline with, for each workflow name, the run at one rerun index.
+    pipeline: Pipeline
+    rerun_index: int
+    workflow_names: Dict[str, Workflow]
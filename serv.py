@@ -1,57 +1,159 @@
 #!/usr/bin/env python3
 
 import argparse
+import fcntl
 import gzip
+import hashlib
 import json
+import multiprocessing
 import os
+import select
+import socket
 import sys
-import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, NamedTuple, Optional
 
+from flask import Flask, Response, abort, g, request
 
-from flask import Flask, abort, request, send_file
-
+import circleci
 import cisummary
+import metrics
 import timeline
+import webhook
 
 app = Flask(__name__)
 
+REQUEST_SECONDS = metrics.Histogram(
+    "serv_request_seconds",
+    "Time taken to handle requests, by route and status, up to the first byte of the response.",
+    ["route", "status"],
+)
+GZIP_SECONDS = metrics.Histogram("serv_gzip_seconds", "Time spent gzipping responses.")
+
+# Whether to add a Server-Timing header with each request's breakdown.
+server_timing = False
+
+# Seconds a view waits for its crawl before showing what has arrived, unless the request gives a
+# ?deadline=; the rest is filled in through /rows. None waits for the whole crawl.
+view_deadline = None
+# The crawls behind /rows live in the process that started them, so with preforked workers, whose
+# polls may land on any of them, views always wait for the whole crawl.
+deadlines = True
+
 try:
     with open("secret", "rb") as f:
         secret = f.read()
 except FileNotFoundError:
     print("not using secret")
+    secret = None
 else:
     print(f"using secret of {len(secret)} bytes")
     app.config["SECRET_KEY"] = secret
 
-try:
-    with open("allowed_slugs.json", "rb") as f:
-        allowed_slugs = set(json.load(f))
-except FileNotFoundError:
-    print(
-        "\x1b[31;1mWARNING: Populate `allowed_slugs.json` with a list of allowed slugs or nothing"
-        " will work!\x1b[m"
-    )
-    allowed_slugs = set()
-except IsADirectoryError:
-    print(
-        "\x1b[31;1mWARNING: `allowed_slugs.json` is a directory, probably because this is running "
-        "in Docker and the file doesn't exist on the host; create it and populate it with a list "
-        "of allowed slugs or nothing will work!\x1b[m"
-    )
-    allowed_slugs = set()
 
-try:
-    with open("ignored_pipelines.json", "rb") as f:
-        ignored_pipelines = {slug: set(pipelines) for slug, pipelines in json.load(f).items()}
-except FileNotFoundError:
-    ignored_pipelines = {}
+def load_allowed_slugs():
+    try:
+        with open("allowed_slugs.json", "rb") as f:
+            return set(json.load(f))
+    except FileNotFoundError:
+        print(
+            "\x1b[31;1mWARNING: Populate `allowed_slugs.json` with a list of allowed slugs or "
+            "nothing will work!\x1b[m"
+        )
+    except IsADirectoryError:
+        print(
+            "\x1b[31;1mWARNING: `allowed_slugs.json` is a directory, probably because this is "
+            "running in Docker and the file doesn't exist on the host; create it and populate it "
+            "with a list of allowed slugs or nothing will work!\x1b[m"
+        )
+    return set()
+
+
+def load_ignored_pipelines():
+    try:
+        with open("ignored_pipelines.json", "rb") as f:
+            return {slug: set(pipelines) for slug, pipelines in json.load(f).items()}
+    except FileNotFoundError:
+        return {}
+
+
+allowed_slugs = load_allowed_slugs()
+ignored_pipelines = load_ignored_pipelines()
+
+CONFIG_FILES = ("allowed_slugs.json", "ignored_pipelines.json")
+
+
+def config_mtimes():
+    mtimes = []
+    for fn in CONFIG_FILES:
+        try:
+            mtimes.append(os.stat(fn).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+# The config files are read again when they change, checked at most this often, so they can be
+# edited without restarting the server (or each of its workers).
+config_check_interval = 2.0
+config_checked_at = time.monotonic()
+config_loaded = config_mtimes()
+config_lock = threading.Lock()
+
+
+def reload_config():
+    global allowed_slugs, ignored_pipelines, config_checked_at, config_loaded
+    with config_lock:
+        if time.monotonic() - config_checked_at < config_check_interval:
+            return
+        config_checked_at = time.monotonic()
+        mtimes = config_mtimes()
+        if mtimes == config_loaded:
+            return
+        try:
+            slugs, ignored = load_allowed_slugs(), load_ignored_pipelines()
+        except ValueError as e:
+            # Most likely caught halfway through being saved; the next check will try again.
+            print(f"not reloading config: {e!r}")
+            return
+        config_loaded = mtimes
+        print(f"reloaded config: {len(slugs)} allowed slugs")
+        allowed_slugs, ignored_pipelines = slugs, ignored
+    # Pages and snapshots may show pipelines that are now ignored.
+    page_cache.invalidate()
+    if refresher is not None:
+        refresher.retain(slugs)
+        # Only the leading worker crawls again; the others pick up the snapshots it saves.
+        if refresher.leading:
+            for slug in slugs:
+                for view_name in VIEWS:
+                    refresher.refresh((slug, view_name))
 
 
 def is_ignored(slug, pipeline):
     return pipeline["number"] in ignored_pipelines.get(slug, set())
 
 
+def client_disconnected():
+    # The client's socket, as the development server and gunicorn pass it on; with any other server
+    # (or over TLS, which can't peek) requests are never seen as abandoned.
+    sock = request.environ.get("werkzeug.socket") or request.environ.get("gunicorn.socket")
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and not sock.recv(1, socket.MSG_PEEK)
+    except ValueError:
+        return False
+    except OSError:
+        return True
+
+
 def get_slug(vcs, org, repo):
     slug = f"{vcs}/{org}/{repo}"
     if slug not in allowed_slugs:
@@ -59,51 +161,450 @@ def get_slug(vcs, org, repo):
     return slug
 
 
-@app.route("/<vcs>/<org>/<repo>/main")
-def main_(vcs, org, repo):
-    slug = get_slug(vcs, org, repo)
-    pages = int(request.args.get("pages", 5))
-    data, meta = cisummary.get_data(
-        slug, "main", pages=pages, jobs=32, pipeline_filter=lambda p: not is_ignored(slug, p)
-    )
-    return str(cisummary.proc(slug, data, meta=meta, description="main"))
+class View(NamedTuple):
+    branch: Optional[str]
+    pages: int
+    pipeline_filter: Callable[[dict], bool]
 
 
-@app.route("/<vcs>/<org>/<repo>/pulls")
-def pulls(vcs, org, repo):
-    slug = get_slug(vcs, org, repo)
-    pages = int(request.args.get("pages", 5))
+VIEWS = {
+    "main": View("main", 5, lambda p: True),
+    "pulls": View(None, 5, lambda p: p.get("vcs", {}).get("branch", "").startswith("pull/")),
+    "tags": View(None, 12, lambda p: "tag" in p.get("vcs", {})),
+}
+
+
+class Page(NamedTuple):
+    body: bytes
+    etag: str
+    fingerprint: str
+    checked_at: float
+
+
+class PageCache:
+    # Rendered, gzipped pages by (slug, view, pages). A page younger than max_age is served as is;
+    # an older one is served again only if a fresh crawl finds the same data behind it, with
+    # nothing still running.
+    def __init__(self, max_age=10, max_entries=256):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def put(self, key, page):
+        with self._lock:
+            self._pages[key] = page
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.max_entries:
+                self._pages.popitem(last=False)
+
+    def invalidate(self, slug=None):
+        with self._lock:
+            for key in list(self._pages):
+                if slug is None or key[0] == slug:
+                    del self._pages[key]
+
+
+page_cache = PageCache()
+
+
+def page_response(page):
+    if page.etag in request.if_none_match:
+        r = Response(status=304)
+    else:
+        r = Response(page.body, content_type="text/html; charset=utf-8")
+        r.headers["Content-Encoding"] = "gzip"
+    r.set_etag(page.etag)
+    r.headers["Cache-Control"] = "no-cache"
+    return r
+
+
+class Snapshot(NamedTuple):
+    data: dict
+    meta: dict
+    fetched_at: float
+    fingerprint: str
+
+
+def fetch_snapshot(slug, view_name, pages, cancelled=None, deadline=None):
+    view = VIEWS[view_name]
     data, meta = cisummary.get_data(
         slug,
-        None,
+        view.branch,
         pages=pages,
         jobs=32,
-        pipeline_filter=lambda p: not is_ignored(slug, p)
-        and p.get("vcs", {}).get("branch", "").startswith("pull/"),
+        pipeline_filter=lambda p: not is_ignored(slug, p) and view.pipeline_filter(p),
+        cancelled=cancelled,
+        # Saved under the view's name only at its usual length, which is what Refresher.get reads.
+        view=view_name if pages == view.pages else f"{view_name}-{pages}",
+        deadline=deadline,
     )
-    return str(cisummary.proc(slug, data, meta=meta, description="pulls"))
+    return Snapshot(data, meta, time.time(), cisummary.fingerprint(data))
+
+
+class Refresher:
+    # Keeps a snapshot of every allowed slug's views at their default page counts, refreshing each
+    # in the background once it's older than its slug's interval. Requests are served from the
+    # snapshot straight away; one that finds it older than stale_after also queues a refresh.
+    #
+    # With several worker processes, only the one running `run` (see `lead`) refreshes on a
+    # schedule. Every process picks up snapshots the others have saved, from cisummary.snapshots.
+    def __init__(self, interval=60, stale_after=30, config=None, workers=2):
+        self.interval = interval
+        self.stale_after = stale_after
+        # slug -> {"interval": seconds, "priority": n}; higher priorities are refreshed first.
+        self.config = config or {}
+        self.snapshots = {}
+        self.leading = False
+        self._lock = threading.Lock()
+        self._inflight = set()
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="refresh")
+
+    def interval_for(self, slug):
+        return self.config.get(slug, {}).get("interval", self.interval)
+
+    def priority_for(self, slug):
+        return self.config.get(slug, {}).get("priority", 0)
+
+    def get(self, slug, view_name):
+        key = (slug, view_name)
+        with self._lock:
+            snapshot = self.snapshots.get(key)
+        loaded = cisummary.snapshots.load(slug, view_name)
+        if loaded is not None and (snapshot is None or loaded[2] > snapshot.fetched_at):
+            data, meta, written_at = loaded
+            snapshot = Snapshot(data, meta, written_at, cisummary.fingerprint(data))
+            with self._lock:
+                self.snapshots[key] = snapshot
+        return snapshot
+
+    def retain(self, slugs):
+        # Forgets the snapshots of slugs that are no longer allowed.
+        with self._lock:
+            self.snapshots = {k: s for k, s in self.snapshots.items() if k[0] in slugs}
+
+    def fetch(self, slug, view_name):
+        snapshot = fetch_snapshot(slug, view_name, VIEWS[view_name].pages)
+        with self._lock:
+            self.snapshots[(slug, view_name)] = snapshot
+        return snapshot
+
+    def refresh(self, key):
+        with self._lock:
+            if key in self._inflight:
+                return
+            self._inflight.add(key)
+        self._pool.submit(self._refresh, key)
+
+    def _refresh(self, key):
+        try:
+            self.fetch(*key)
+        except Exception as e:
+            print(f"refreshing {key} failed: {e!r}")
+        finally:
+            with self._lock:
+                self._inflight.discard(key)
+
+    def due(self):
+        now = time.time()
+        due = []
+        for slug in allowed_slugs:
+            for view_name in VIEWS:
+                snapshot = self.get(slug, view_name)
+                age = now - snapshot.fetched_at if snapshot else float("inf")
+                if age >= self.interval_for(slug):
+                    due.append((-self.priority_for(slug), -age, (slug, view_name)))
+        return [key for _, _, key in sorted(due)]
+
+    def run(self, tick=1.0):
+        self.leading = True
+        while True:
+            for key in self.due():
+                self.refresh(key)
+            time.sleep(tick)
+
+
+refresher = None
+
+
+def view_snapshot(slug, view_name, pages, deadline=None):
+    # The refresher's snapshots are always complete, so the deadline only applies to crawls made
+    # for this request.
+    if refresher is None or pages != VIEWS[view_name].pages:
+        return fetch_snapshot(
+            slug, view_name, pages, cancelled=client_disconnected, deadline=deadline
+        )
+    snapshot = refresher.get(slug, view_name)
+    if snapshot is None:
+        return refresher.fetch(slug, view_name)
+    if time.time() - snapshot.fetched_at > refresher.stale_after and refresher.leading:
+        refresher.refresh((slug, view_name))
+    return snapshot
+
+
+def render_view(slug, view_name):
+    pages = int(request.args.get("pages", VIEWS[view_name].pages))
+    deadline = request.args.get("deadline", view_deadline, type=float) if deadlines else None
+    key = (slug, view_name, pages)
+
+    page = page_cache.get(key)
+    if page is not None and time.time() - page.checked_at < page_cache.max_age:
+        return page_response(page)
+
+    snapshot = view_snapshot(slug, view_name, pages, deadline)
+    # Pages of running workflows show how long they've been running, so are rendered again.
+    if (
+        page is not None
+        and page.fingerprint == snapshot.fingerprint
+        and not cisummary.live(snapshot.data)
+    ):
+        page = page._replace(checked_at=time.time())
+        page_cache.put(key, page)
+        return page_response(page)
+
+    meta = dict(snapshot.meta, snapshot_at=snapshot.fetched_at)
+    chunks = cisummary.proc_stream(slug, snapshot.data, meta=meta, description=view_name)
+    if "deferred" in meta:
+        # Placeholders and all; not worth keeping, since the crawl will soon have the rest.
+        return Response(chunks, content_type="text/html")
+    return Response(cache_page(key, snapshot.fingerprint, chunks), content_type="text/html")
+
+
+def gzip_compress(data):
+    with metrics.timed(GZIP_SECONDS, timing="gzip"):
+        return gzip.compress(data)
+
+
+def cache_page(key, fingerprint, chunks):
+    # Pass the rendered chunks through to the client and cache the page once it's complete.
+    rendered = []
+    for chunk in chunks:
+        rendered.append(chunk)
+        yield chunk
+    body = "".join(rendered).encode()
+    page = Page(
+        body=gzip_compress(body),
+        etag=hashlib.sha256(body).hexdigest()[:32],
+        fingerprint=fingerprint,
+        checked_at=time.time(),
+    )
+    page_cache.put(key, page)
+
+
+def gzip_stream(chunks):
+    # Flush after every chunk so each one reaches the client as soon as it's rendered.
+    z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elapsed = 0.0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            t0 = time.perf_counter()
+            out = z.compress(chunk) + z.flush(zlib.Z_SYNC_FLUSH)
+            elapsed += time.perf_counter() - t0
+            yield out
+        yield z.flush()
+        GZIP_SECONDS.observe(elapsed)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+@app.route("/<vcs>/<org>/<repo>/main")
+def main_(vcs, org, repo):
+    return render_view(get_slug(vcs, org, repo), "main")
+
+
+@app.route("/<vcs>/<org>/<repo>/pulls")
+def pulls(vcs, org, repo):
+    return render_view(get_slug(vcs, org, repo), "pulls")
 
 
 @app.route("/<vcs>/<org>/<repo>/tags")
 def tags(vcs, org, repo):
+    return render_view(get_slug(vcs, org, repo), "tags")
+
+
+@app.route("/<vcs>/<org>/<repo>/rows/<crawl_id>")
+def rows(vcs, org, repo, crawl_id):
+    # The rows of pipelines that a page rendered at its deadline showed as placeholders, as JSON
+    # {"rows": {number: html}, "done": bool, "reload": bool}, once some of them have arrived. The
+    # page reloads if the crawl turned out to have more columns than it has.
     slug = get_slug(vcs, org, repo)
-    pages = int(request.args.get("pages", 12))
-    data, meta = cisummary.get_data(
-        slug,
-        None,
-        pages=pages,
-        jobs=32,
-        pipeline_filter=lambda p: not is_ignored(slug, p) and "tag" in p.get("vcs", {}),
+    deferred = cisummary.deferred_crawls.get(crawl_id)
+    if deferred is None or deferred.slug != slug:
+        abort(404)
+    try:
+        numbers = [int(n) for n in request.args.get("pipelines", "").split(",") if n]
+    except ValueError:
+        abort(400)
+    rows, done = cisummary.deferred_rows(deferred, numbers)
+    body = {"rows": rows, "done": done, "reload": done and deferred.columns_changed()}
+    r = Response(json.dumps(body), content_type="application/json")
+    r.headers["Cache-Control"] = "no-store"
+    return r
+
+
+@app.route("/<vcs>/<org>")
+def overview(vcs, org):
+    org_slug = f"{vcs}/{org}"
+    slugs = sorted(slug for slug in allowed_slugs if slug.startswith(org_slug + "/"))
+    if not slugs:
+        abort(404)
+    statuses, meta = cisummary.get_overview(
+        org_slug, slugs, pipeline_filter=lambda slug, p: not is_ignored(slug, p)
     )
-    return str(cisummary.proc(slug, data, meta=meta, description="tags"))
+    return str(cisummary.proc_overview(org_slug, statuses, meta=meta))
+
+
+TIMELINE_TYPES = {"svg": "image/svg+xml", "pdf": "application/pdf", "png": "image/png"}
+
+
+class Timeline(NamedTuple):
+    # Gzipped, like Page.body.
+    body: bytes
+    etag: str
+    finished: bool
+
+
+class TimelineCache:
+    # Rendered timelines of finished workflows by (uuid, format). Those never change, so entries
+    # are only evicted, least recently used first, to keep the bodies under max_bytes in total.
+    def __init__(self, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._timelines = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            t = self._timelines.get(key)
+            if t is not None:
+                self._timelines.move_to_end(key)
+            return t
+
+    def put(self, key, t):
+        with self._lock:
+            old = self._timelines.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old.body)
+            self._timelines[key] = t
+            self.bytes += len(t.body)
+            while self.bytes > self.max_bytes and self._timelines:
+                _, evicted = self._timelines.popitem(last=False)
+                self.bytes -= len(evicted.body)
+
+
+timeline_cache = TimelineCache()
+
+# matplotlib renders run in worker processes so they don't hold the GIL against request threads.
+# Workers are forked from a single-threaded server process, never from this multithreaded one.
+timeline_workers = 2
+timeline_pool = None
+timeline_pool_lock = threading.Lock()
+
+
+def render_timeline(lay, fmt):
+    global timeline_pool
+    if fmt == "svg":
+        # Cheap enough that shipping the layout to another process would cost more.
+        return timeline.render_layout(lay, fmt)
+    with timeline_pool_lock:
+        if timeline_pool is None:
+            timeline_pool = ProcessPoolExecutor(
+                timeline_workers, mp_context=multiprocessing.get_context("forkserver")
+            )
+        pool = timeline_pool
+    try:
+        return pool.submit(timeline.render_layout, lay, fmt).result()
+    except BrokenProcessPool:
+        # A worker died; start a fresh pool for the next request.
+        with timeline_pool_lock:
+            if timeline_pool is pool:
+                timeline_pool = None
+        raise
+
+
+def timeline_response(t, content_type):
+    if t.etag in request.if_none_match:
+        r = Response(status=304)
+    else:
+        r = Response(t.body, content_type=content_type)
+        r.headers["Content-Encoding"] = "gzip"
+    r.set_etag(t.etag)
+    r.headers["Cache-Control"] = (
+        "public, max-age=31536000, immutable" if t.finished else "no-cache"
+    )
+    return r
 
 
 @app.route("/<vcs>/<org>/<repo>/workflow_timeline/<uuid>")
 def workflow_timeline(vcs, org, repo, uuid):
-    with tempfile.TemporaryDirectory() as d:
-        fn = os.path.join(d, "timeline.pdf")
-        timeline.make(uuid, fn)
-        return send_file(fn)
+    fmt = request.args.get("format", "svg")
+    if fmt not in TIMELINE_TYPES:
+        abort(400)
+    key = (uuid, fmt)
+    t = timeline_cache.get(key)
+    if t is None:
+        jobs = timeline.fetch(uuid)
+        try:
+            with metrics.timed(timeline.RENDER_SECONDS, fmt, timing="render"):
+                body = render_timeline(timeline.layout(jobs), fmt)
+        except ImportError:
+            # PDFs and PNGs need matplotlib, which is optional.
+            abort(501)
+        t = Timeline(
+            body=gzip_compress(body),
+            etag=hashlib.sha256(body).hexdigest()[:32],
+            finished=timeline.finished(jobs),
+        )
+        if t.finished:
+            timeline_cache.put(key, t)
+    return timeline_response(t, TIMELINE_TYPES[fmt])
+
+
+webhook_log = None
+
+
+@app.route("/webhook", methods=["POST"])
+def webhook_():
+    # CircleCI pushes workflow-completed and job-completed events here. They're applied to the
+    # cached records in place, and the pages showing that project are rendered again.
+    if secret is None:
+        abort(404)
+    body = request.get_data()
+    if not webhook.verify(secret, body, request.headers.get("circleci-signature", "")):
+        abort(401)
+    try:
+        event = json.loads(body)
+        event_id = str(event["id"])
+        if event.get("type") in webhook.EVENT_TYPES:
+            slug = circleci.full_slug(event["project"]["slug"])
+            update = cisummary.event_update(event)
+        else:
+            slug = update = None
+    except (ValueError, KeyError, TypeError, AttributeError):
+        abort(400)
+    if webhook_log is not None:
+        fn = os.path.basename(f"{event_id}.json")
+        with open(os.path.join(webhook_log, fn), "wb") as f:
+            f.write(body)
+    if update is None or slug not in allowed_slugs:
+        return "", 204
+
+    cisummary.apply_event(slug, update)
+    page_cache.invalidate(slug)
+    if refresher is not None:
+        for view_name in VIEWS:
+            refresher.refresh((slug, view_name))
+    return "", 204
 
 
 @app.route("/")
@@ -111,27 +612,222 @@ def root():
     return ""
 
 
+@app.route("/metrics")
+def metrics_():
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.errorhandler(cisummary.Cancelled)
+def cancelled(e):
+    # The client went away mid-crawl; nobody is listening for a response.
+    return "", 499
+
+
+@app.before_request
+def start_request():
+    g.started = time.perf_counter()
+    reload_config()
+    if server_timing:
+        metrics.start_timings()
+
+
+# Registered before compress, so it runs after it and can count the time spent compressing.
+@app.after_request
+def finish_request(r):
+    elapsed = time.perf_counter() - g.started
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    REQUEST_SECONDS.observe(elapsed, route, r.status_code)
+    if server_timing:
+        timings = metrics.stop_timings() + [("total", elapsed)]
+        r.headers["Server-Timing"] = ", ".join(
+            f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings
+        )
+    return r
+
+
 @app.after_request
 def compress(r):
-    if "Content-Encoding" in r.headers:
+    if "Content-Encoding" in r.headers or r.status_code == 304 or r.direct_passthrough:
+        return r
+    if r.is_streamed:
+        r.response = gzip_stream(r.response)
+        r.headers["Content-Encoding"] = "gzip"
         return r
     try:
         r.get_data()
     except RuntimeError:
         return r
-    r.set_data(gzip.compress(r.get_data()))
+    r.set_data(gzip_compress(r.get_data()))
     r.headers["Content-Encoding"] = "gzip"
     return r
 
 
+# Set by --warm-up: crawl every allowed slug once at startup.
+warm_up_at_boot = False
+
+
+def warm_up():
+    t0 = time.monotonic()
+    for slug in sorted(allowed_slugs):
+        for view_name, view in VIEWS.items():
+            try:
+                if refresher is not None:
+                    refresher.fetch(slug, view_name)
+                else:
+                    fetch_snapshot(slug, view_name, view.pages)
+            except Exception as e:
+                print(f"warming up {slug} {view_name} failed: {e!r}")
+    print(f"warmed up {len(allowed_slugs)} slugs in {time.monotonic() - t0:.1f}s")
+
+
+def background():
+    if warm_up_at_boot:
+        warm_up()
+    if refresher is not None:
+        refresher.run()
+
+
+def lead(path, fn):
+    # Runs fn on a thread of its own once this process holds an exclusive lock on path, so that of
+    # several worker processes one at a time does it. The lock is held until the process exits,
+    # and then passes to another one, which starts fn over.
+    def run():
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        fn()
+
+    threading.Thread(target=run, name="leader", daemon=True).start()
+
+
+def serve_workers(args):
+    # Preforked gunicorn workers, each serving with a pool of threads. gunicorn is only needed for
+    # this, so it's imported here. Nothing may have started a thread before the workers are forked.
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{args.bind}:{args.port}")
+            self.cfg.set("workers", args.workers or os.cpu_count())
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("threads", args.threads)
+            self.cfg.set("post_worker_init", lambda worker: lead(args.lock_file, background))
+
+        def load(self):
+            return app
+
+    global deadlines
+    if view_deadline is not None:
+        print("--deadline is ignored with --workers: views wait for their whole crawl")
+    deadlines = False
+    Server().run()
+
+
 def main(args):
     parser = argparse.ArgumentParser()
     parser.add_argument("-b", "--bind", default="127.0.0.1")
     parser.add_argument("-d", "--debug", action="store_true")
     parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument(
+        "-w", "--workers", type=int, default=None, help="serve with gunicorn (0: one per core)"
+    )
+    parser.add_argument("--threads", type=int, default=16, help="threads per worker")
+    parser.add_argument("--lock-file", default="serv.lock", help="elects the worker that refreshes")
+    parser.add_argument("--warm-up", action="store_true", help="crawl allowed slugs at startup")
+    parser.add_argument("--connect-timeout", type=float, default=None)
+    parser.add_argument("--read-timeout", type=float, default=None)
+    parser.add_argument("--fetchers", type=int, default=None)
+    parser.add_argument("--engine", choices=cisummary.ENGINES, default=None)
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument(
+        "--cache", default=None, help="cache directory, or SQLite file ending in .db"
+    )
+    parser.add_argument("--cache-max-bytes", type=int, default=None)
+    parser.add_argument("--cache-max-age", type=float, default=None)
+    parser.add_argument("--memory-cache-bytes", type=int, default=None)
+    parser.add_argument("--live-ttl", type=float, default=None)
+    parser.add_argument("--page-cache-ttl", type=float, default=None)
+    parser.add_argument("--overview-deadline", type=float, default=None)
+    parser.add_argument(
+        "--deadline", type=float, default=None, help="seconds to wait for a view's crawl"
+    )
+    parser.add_argument("--timeline-cache-bytes", type=int, default=None)
+    parser.add_argument("--timeline-workers", type=int, default=None)
+    parser.add_argument("--server-timing", action="store_true", help="add Server-Timing headers")
+    parser.add_argument("--webhook-log", default=None, help="directory to record webhooks in")
+    parser.add_argument("--refresh", action="store_true", help="keep view snapshots refreshed")
+    parser.add_argument("--refresh-interval", type=float, default=60)
+    parser.add_argument("--stale-after", type=float, default=30)
+    parser.add_argument(
+        "--refresh-config",
+        default=None,
+        help="JSON file of per-slug settings, "
+        'e.g. {"github/org/repo": {"interval": 30, "priority": 1}}',
+    )
 
     args = parser.parse_args(args)
 
+    circleci.transport.configure(
+        connect_timeout=args.connect_timeout, read_timeout=args.read_timeout
+    )
+
+    if args.fetchers is not None:
+        cisummary.executor = cisummary.FetchExecutor(args.fetchers)
+    if args.engine is not None:
+        cisummary.default_engine = args.engine
+    if args.incremental:
+        cisummary.default_incremental = True
+    if args.cache is not None:
+        circleci.cache = circleci.open_cache(
+            args.cache, max_bytes=args.cache_max_bytes, max_age=args.cache_max_age
+        )
+    if args.memory_cache_bytes is not None:
+        circleci.memory_cache.max_bytes = args.memory_cache_bytes
+    if args.live_ttl is not None:
+        circleci.memory_cache.live_ttl = args.live_ttl
+    if args.page_cache_ttl is not None:
+        page_cache.max_age = args.page_cache_ttl
+    if args.overview_deadline is not None:
+        cisummary.overview_deadline = args.overview_deadline
+    if args.deadline is not None:
+        global view_deadline
+        view_deadline = args.deadline
+    if args.timeline_cache_bytes is not None:
+        timeline_cache.max_bytes = args.timeline_cache_bytes
+    if args.timeline_workers is not None:
+        global timeline_workers
+        timeline_workers = args.timeline_workers
+
+    if args.server_timing:
+        global server_timing
+        server_timing = True
+    if args.webhook_log is not None:
+        global webhook_log
+        webhook_log = args.webhook_log
+        os.makedirs(webhook_log, exist_ok=True)
+
+    if args.warm_up and args.workers is not None and not args.refresh:
+        # Only the leading worker warms up, and the others only read its snapshots through the
+        # refresher.
+        print("--warm-up with --workers implies --refresh")
+        args.refresh = True
+    if args.refresh:
+        global refresher
+        config = None
+        if args.refresh_config:
+            with open(args.refresh_config) as f:
+                config = json.load(f)
+        refresher = Refresher(
+            interval=args.refresh_interval, stale_after=args.stale_after, config=config
+        )
+    if args.warm_up:
+        global warm_up_at_boot
+        warm_up_at_boot = True
+
+    if args.workers is not None:
+        serve_workers(args)
+        return
+    if warm_up_at_boot or refresher is not None:
+        threading.Thread(target=background, name="background", daemon=True).start()
     app.run(host=args.bind, port=args.port, debug=args.debug)
 
 
@@ -0,0 +1,105 @@
+import pytest
+
+import circleci
+import cisummary
+import fakeapi
+
+SLUG = "github/example/repo"
+
+
+@pytest.fixture
+def latency():
+    return 0.0
+
+
+@pytest.fixture
+def pipelines():
+    return 20
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch, latency, pipelines):
+    server, org = fakeapi.serve(
+        [SLUG], pipelines=pipelines, workflows=2, jobs=4, running=2, latency=latency
+    )
+    monkeypatch.setattr(circleci, "token", "x")
+    monkeypatch.setattr(circleci, "API_URL", f"http://127.0.0.1:{server.server_port}/api")
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "cache").mkdir()
+    circleci.memory_cache.clear()
+    cisummary.sync_states.clear()
+    yield org
+    server.shutdown()
+    circleci.memory_cache.clear()
+    cisummary.sync_states.clear()
+
+
+def finish(org, pipeline_number):
+    pipeline = next(p for p in org.pipelines[SLUG] if p["number"] == pipeline_number)
+    for w in org.workflows[pipeline["id"]]:
+        w["status"] = "success"
+        w["stopped_at"] = fakeapi.iso(fakeapi.T0)
+        for j in org.jobs[w["id"]]:
+            j["status"] = "success"
+            j["stopped_at"] = fakeapi.iso(fakeapi.T0)
+
+
+def job_statuses(pipelines, number):
+    return {j.status for w in pipelines[number].workflows for j in w.jobs}
+
+
+@pytest.mark.parametrize("engine", ["threads", "async"])
+def test_incremental_refetches_jobs_of_workflows_that_finished(api, engine):
+    if engine == "async":
+        pytest.importorskip("aiohttp")
+    pipelines, _ = cisummary.get_data(SLUG, None, pages=1, engine=engine, incremental=True)
+    assert job_statuses(pipelines, 20) == {"success", "running"}
+
+    finish(api, 20)
+    circleci.memory_cache.clear()
+    for _ in range(2):
+        pipelines, _ = cisummary.get_data(SLUG, None, pages=1, engine=engine, incremental=True)
+        assert job_statuses(pipelines, 20) == {"success"}
+        assert job_statuses(pipelines, 19) == {"success", "running"}
+
+
+@pytest.mark.parametrize("latency", [0.1])
+@pytest.mark.parametrize("engine", ["threads", "async"])
+def test_deadline_waits_for_a_pipeline_to_show(api, engine):
+    if engine == "async":
+        pytest.importorskip("aiohttp")
+    # Well before even the first listing page can arrive.
+    pipelines, meta = cisummary.get_data(SLUG, None, pages=1, engine=engine, deadline=0.01)
+    assert meta["loading"]
+    assert any(p.workflows for p in pipelines.values())
+
+    deferred = cisummary.deferred_crawls.get(meta["deferred"])
+    rows, done = cisummary.deferred_rows(deferred, meta["loading"], wait=10)
+    assert rows and all("/jobs/" in row for row in rows.values())
+    assert deferred.done.wait(10)
+
+
+@pytest.mark.parametrize("pipelines", [200])
+@pytest.mark.parametrize("latency", [0.3])
+def test_overview_deadline_counts_from_each_repos_start(api):
+    quiet = "github/example/quiet"
+    # Listing all the org's pages takes longer than the deadline, but the first has the busy repo's
+    # latest pipeline.
+    statuses, _ = cisummary.get_overview("github/example", [SLUG, quiet], pages=5, deadline=1.0)
+    assert statuses[0].pipeline is not None
+    assert statuses[1].error == "no recent pipelines on main"
+
+
+def test_settled_workflow_listing_is_refetched_once_old(api, monkeypatch):
+    pipeline = api.pipelines[SLUG][-1]
+    assert len(circleci.pipeline_workflows(pipeline["id"])["items"]) == 2
+
+    # A rerun no webhook told us about.
+    rerun = dict(api.workflows[pipeline["id"]][0], id="rerun")
+    api.workflows[pipeline["id"]].append(rerun)
+    circleci.memory_cache.clear()
+    assert len(circleci.pipeline_workflows(pipeline["id"])["items"]) == 2
+
+    monkeypatch.setattr(circleci, "settled_max_age", 0)
+    circleci.memory_cache.clear()
+    assert len(circleci.pipeline_workflows(pipeline["id"])["items"]) == 3
@@ -0,0 +1,111 @@
+import gzip
+import json
+import time
+
+import pytest
+
+import cisummary
+import fakeapi
+import serv
+import webhook
+from model import Pipeline
+
+SECRET = b"secret"
+SLUG = "github/example/repo"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(serv, "secret", SECRET)
+    monkeypatch.setattr(serv, "webhook_log", None)
+    return serv.app.test_client()
+
+
+def post_webhook(client, body):
+    headers = {"circleci-signature": "v1=" + webhook.sign(SECRET, body)}
+    return client.post("/webhook", data=body, headers=headers)
+
+
+@pytest.mark.parametrize(
+    "event",
+    [
+        b"{not json",
+        b"[]",
+        json.dumps({"type": "workflow-completed"}).encode(),
+        json.dumps({"id": "1", "type": "job-completed", "project": {"slug": "gh/o/r"}}).encode(),
+        json.dumps(
+            {
+                "id": "1",
+                "type": "workflow-completed",
+                "project": {"slug": "gh/o/r"},
+                "pipeline": {"id": "p", "number": 1},
+                "workflow": {"id": "w", "status": "success"},
+            }
+        ).encode(),
+    ],
+)
+def test_malformed_webhook_is_rejected(client, event):
+    assert post_webhook(client, event).status_code == 400
+
+
+def test_webhook_of_other_type_is_ignored(client):
+    event = json.dumps({"id": "1", "type": "ping"}).encode()
+    assert post_webhook(client, event).status_code == 204
+
+
+@pytest.fixture
+def config_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # reload_config replaces these; monkeypatch puts them back.
+    monkeypatch.setattr(serv, "allowed_slugs", serv.allowed_slugs)
+    monkeypatch.setattr(serv, "ignored_pipelines", serv.ignored_pipelines)
+    monkeypatch.setattr(serv, "config_check_interval", 0)
+    monkeypatch.setattr(serv, "config_loaded", None)
+    return tmp_path
+
+
+def test_config_reload_refreshes_only_in_the_leading_worker(config_dir, monkeypatch):
+    refresher = serv.Refresher()
+    refreshed = []
+    monkeypatch.setattr(refresher, "refresh", refreshed.append)
+    monkeypatch.setattr(serv, "refresher", refresher)
+    refresher.snapshots = {("github/o/gone", "main"): None, ("github/o/kept", "main"): None}
+    (config_dir / "allowed_slugs.json").write_text('["github/o/kept"]')
+
+    serv.reload_config()
+    assert serv.allowed_slugs == {"github/o/kept"}
+    assert not refreshed
+    assert list(refresher.snapshots) == [("github/o/kept", "main")]
+
+    refresher.leading = True
+    serv.config_loaded = None
+    serv.reload_config()
+    assert sorted(refreshed) == [("github/o/kept", view) for view in sorted(serv.VIEWS)]
+
+
+def snapshot_of(running):
+    org = fakeapi.FakeOrg([SLUG], pipelines=3, workflows=1, jobs=2, running=running)
+    data = {
+        p["number"]: Pipeline.from_api(p, org.workflows[p["id"]], org.jobs)
+        for p in org.pipelines[SLUG]
+    }
+    meta = {"uncached_requests": 0, "total_requests": 0}
+    return serv.Snapshot(data, meta, time.time(), cisummary.fingerprint(data))
+
+
+@pytest.mark.parametrize("running", [0, 1])
+def test_page_reuse_depends_on_running_workflows(client, monkeypatch, running):
+    snapshot = snapshot_of(running)
+    monkeypatch.setattr(serv, "allowed_slugs", {SLUG})
+    monkeypatch.setattr(serv, "view_snapshot", lambda *args: snapshot)
+    monkeypatch.setattr(serv.page_cache, "max_age", 0)
+    serv.page_cache.invalidate()
+
+    body = gzip.decompress(client.get(f"/{SLUG}/main").get_data()).decode()
+    fetched = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(snapshot.fetched_at))
+    assert f"data fetched at {fetched} GMT" in body
+    etag = serv.page_cache.get((SLUG, "main", serv.VIEWS["main"].pages)).etag
+    time.sleep(1)
+    r = client.get(f"/{SLUG}/main", headers={"If-None-Match": etag})
+    # A page with a running workflow has its duration (and time of rendering) brought up to date.
+    assert r.status_code == (200 if running else 304)
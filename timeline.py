@@ -1,53 +1,63 @@
 #!/usr/bin/env python3
 
-from typing import List, NamedTuple
+import io
 import os
 import sys
-import time
-
-from matplotlib import pyplot as plt, ticker
-import matplotlib
+from typing import List, NamedTuple
+from xml.sax.saxutils import escape
 
 import circleci
+import metrics
+from model import Job
+
+RENDER_SECONDS = metrics.Histogram(
+    "timeline_render_seconds", "Time taken to render workflow timelines, by format.", ["format"]
+)
 
 
-def parse_time(s):
-    return time.mktime(time.strptime(s, "%Y-%m-%dT%H:%M:%SZ")) / 60 if s else None
+def minutes(t):
+    return t / 60 if t else None
 
 
-class Job(NamedTuple):
-    id: str
-    name: str
+class Bar(NamedTuple):
+    job: Job
     start: float
     stop: float
-    status: str
-    dependencies: List[str]
-
-    @staticmethod
-    def from_json(j):
-        print(j)
-        return Job(
-            id=j["id"],
-            name=j["name"],
-            start=parse_time(j["started_at"]),
-            stop=parse_time(j.get("stopped_at")),
-            status=j["status"],
-            dependencies=j["dependencies"],
-        )
+    # Rows row0 up to (not including) row1, counting from the bottom.
+    row0: int
+    row1: int
 
 
-def make(workflow_id, out_fn):
-    jobs = [Job.from_json(x) for x in circleci.workflow_jobs(workflow_id)["items"]]
+class Layout(NamedTuple):
+    # Bars are positioned in minutes from the first job's start, and in rows: each job gets the
+    # rows of all the jobs that waited on it last, or a single row if none did.
+    bars: List[Bar]
+    duration: float
+    rows: int
+
+
+def fetch(workflow_id):
+    jobs = []
+    token = None
+    while True:
+        r = circleci.workflow_jobs(workflow_id, page_token=token)
+        jobs.extend(Job.from_api(x) for x in r["items"])
+        token = r.get("next_page_token")
+        if not token:
+            return jobs
+
+
+def layout(jobs):
     by_id = {j.id: j for j in jobs}
 
     deps = {
-        j.id: [by_id[d] for d in j.dependencies if by_id[d].stop]
+        j.id: [by_id[d] for d in j.dependencies if d in by_id and by_id[d].stopped]
         if j.dependencies
         else None
         for j in jobs
     }
     parents = {
-        j: max(ds, key=lambda d: d.stop) if ds else None for j, ds in deps.items()
+        j: max(ds, key=lambda d: d.stopped) if ds else None for j, ds in deps.items()
     }
     children = {j.id: [] for j in jobs}
     children[None] = []
@@ -71,45 +81,140 @@ def make(workflow_id, out_fn):
 
     y1 = proc(None, 0)
 
-    t0 = min(x.start for x in jobs if x.start)
-    t1 = max(x.stop for x in jobs if x.stop)
-    fig = plt.figure(figsize=(20, 6))
-    ax = fig.add_subplot()
-    margin = 0.03
+    started = [x.started for x in jobs if x.started]
+    stopped = [x.stopped for x in jobs if x.stopped]
+    if not started or not stopped:
+        return Layout([], 0, y1)
+    t0 = minutes(min(started))
+    t1 = minutes(max(stopped))
+
+    bars = []
     for j, (a, b) in ranges.items():
         if j is None:
             continue
         job = by_id[j]
-        if not job.stop or not job.start:
+        if not job.stopped or not job.started:
             continue
+        bars.append(Bar(job, minutes(job.started) - t0, minutes(job.stopped) - t0, a, b))
+    return Layout(bars, t1 - t0, y1)
+
+
+def short_name(name):
+    return "-".join(s[:4] for s in name.split("-"))
+
+
+def render_svg(lay, width=1600, height=480):
+    # The same picture as render_mpl, as a standalone SVG document that can be inlined in HTML.
+    pad_x, pad_top, pad_bottom = 10, 10, 24
+    plot_w, plot_h = width - 2 * pad_x, height - pad_top - pad_bottom
+    duration = lay.duration or 1
+    rows = lay.rows or 1
+
+    def x(t):
+        return pad_x + t / duration * plot_w
+
+    def y(row):
+        # Row 0 is at the bottom, as on the matplotlib axes.
+        return pad_top + plot_h - row / rows * plot_h
+
+    out = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {width} {height}" '
+        f'width="100%" font-family="sans-serif" font-size="11">',
+        f'<rect x="{pad_x}" y="{pad_top}" width="{plot_w}" height="{plot_h}" fill="none" '
+        'stroke="#000"/>',
+    ]
+    for m in range(1, int(duration) + 1):
+        major = m % 2 == 0
+        out.append(
+            f'<line x1="{x(m):.1f}" y1="{pad_top}" x2="{x(m):.1f}" y2="{pad_top + plot_h}" '
+            f'stroke="#333" stroke-opacity="{0.4 if major else 0.15}"/>'
+        )
+        if major:
+            out.append(
+                f'<text x="{x(m):.1f}" y="{height - 8}" text-anchor="middle">{m}</text>'
+            )
+    margin = 0.03
+    for bar in lay.bars:
+        x0, x1 = x(bar.start), x(bar.stop)
+        y0, y1 = y(bar.row1 - margin), y(bar.row0 + margin)
+        job = bar.job
+        out.append(
+            f'<g><title>{escape(job.name)} ({escape(job.status)}): '
+            f"{(bar.stop - bar.start):.1f} min</title>"
+            f'<rect x="{x0:.1f}" y="{y0:.1f}" width="{x1 - x0:.1f}" height="{y1 - y0:.1f}" '
+            'fill="#1f77b4"/>'
+            f'<text x="{(x0 + x1) / 2:.1f}" y="{(y0 + y1) / 2:.1f}" text-anchor="middle" '
+            f'dominant-baseline="central">{escape(short_name(job.name))}</text></g>'
+        )
+    out.append("</svg>")
+    return "".join(out)
+
+
+def render_mpl(lay, out, fmt="pdf"):
+    # matplotlib is only needed here, so it's imported on first use rather than at startup. The
+    # Figure is created directly instead of through pyplot, so nothing keeps it alive afterwards.
+    import matplotlib.patches
+    from matplotlib import ticker
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(20, 6))
+    ax = fig.add_subplot()
+    margin = 0.03
+    for bar in lay.bars:
         ax.add_patch(
             matplotlib.patches.Rectangle(
-                (job.start - t0, a + margin), job.stop - job.start, b - a - 2 * margin
+                (bar.start, bar.row0 + margin),
+                bar.stop - bar.start,
+                bar.row1 - bar.row0 - 2 * margin,
             )
         )
         ax.text(
-            (job.start + job.stop) / 2 - t0,
-            (a + b) / 2,
-            "-".join(s[:4] for s in job.name.split("-")),
+            (bar.start + bar.stop) / 2,
+            (bar.row0 + bar.row1) / 2,
+            short_name(bar.job.name),
             horizontalalignment="center",
             verticalalignment="center",
         )
 
-    ax.set_xlim(0, t1 - t0)
-    ax.set_ylim(0, y1)
-    # ax.set_xticks(range(0, math.ceil(t1 - t0), 2))
+    ax.set_xlim(0, lay.duration)
+    ax.set_ylim(0, lay.rows)
     ax.xaxis.set_major_locator(ticker.MultipleLocator(2))
     ax.xaxis.set_minor_locator(ticker.MultipleLocator(1))
     ax.set_yticks([])
     ax.grid(True, color="#333", alpha=0.4)
     ax.grid(True, color="#333", alpha=0.15, which="minor")
     fig.tight_layout()
-    fig.savefig(out_fn)
+    fig.savefig(out, format=fmt)
+
+
+def finished(jobs):
+    # A workflow without jobs yet may just not have had them listed.
+    return bool(jobs) and all(j.status in circleci.FINISHED_JOB_STATUSES for j in jobs)
+
+
+def render_layout(lay, fmt="svg"):
+    if fmt == "svg":
+        return render_svg(lay).encode()
+    buf = io.BytesIO()
+    render_mpl(lay, buf, fmt)
+    return buf.getvalue()
+
+
+def render(workflow_id, fmt="svg"):
+    lay = layout(fetch(workflow_id))
+    with metrics.timed(RENDER_SECONDS, fmt, timing="render"):
+        return render_layout(lay, fmt)
+
+
+def make(workflow_id, out_fn):
+    fmt = os.path.splitext(out_fn)[1][1:] or "pdf"
+    with open(out_fn, "wb") as f:
+        f.write(render(workflow_id, fmt))
 
 
 def main(args):
     workflow_id = os.path.basename(args[0])
-    make(workflow_id, "timeline.pdf")
+    make(workflow_id, args[1] if len(args) > 1 else "timeline.pdf")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Signing and checking of CircleCI webhook payloads, and a tool to replay recorded ones (see serv.py
+# --webhook-log) against a running server, signed with the same secret file it uses.
+
+import argparse
+import hashlib
+import hmac
+import json
+import sys
+
+import requests
+
+EVENT_TYPES = {"workflow-completed", "job-completed"}
+
+
+def sign(secret, body):
+    # The file usually ends in a newline, which isn't part of the secret CircleCI was given.
+    return hmac.new(secret.strip(), body, hashlib.sha256).hexdigest()
+
+
+def verify(secret, body, header):
+    # The header is a comma-separated list of version=signature pairs; only v1 is defined.
+    expected = sign(secret, body)
+    for part in header.split(","):
+        version, _, signature = part.strip().partition("=")
+        if version == "v1" and hmac.compare_digest(signature, expected):
+            return True
+    return False
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", help="e.g. http://localhost:8080/webhook")
+    parser.add_argument("payloads", nargs="+", help="recorded payload files")
+    parser.add_argument("--secret", default="secret", help="file holding the webhook secret")
+
+    args = parser.parse_args(args)
+
+    with open(args.secret, "rb") as f:
+        secret = f.read()
+
+    bodies = []
+    for fn in args.payloads:
+        with open(fn, "rb") as f:
+            bodies.append(f.read())
+    # Deliver them in the order they happened, whatever order the files were given in.
+    bodies.sort(key=lambda body: json.loads(body).get("happened_at", ""))
+
+    for body in bodies:
+        event = json.loads(body)
+        r = requests.post(
+            args.url,
+            data=body,
+            headers={
+                "Content-Type": "application/json",
+                "circleci-event-type": event.get("type", ""),
+                "circleci-signature": f"v1={sign(secret, body)}",
+            },
+        )
+        print(r.status_code, event.get("type"), event.get("id"))
+
+
+if __name__ == "__main__":
+    exit(main(sys.argv[1:]))